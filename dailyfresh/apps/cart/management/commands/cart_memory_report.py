@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from redis.exceptions import ResponseError
+from cart.models import CartArchive
+from cart.utils import get_cart_connection, iter_cart_user_ids, cart_key, cart_totals_key
+
+
+class Command(BaseCommand):
+    """统计redis中购物车占用的内存: python manage.py cart_memory_report"""
+    help = '统计redis中购物车的数量、内存占用、编码方式及转存到数据库的购物车数量'
+
+    def handle(self, *args, **options):
+        con = get_cart_connection()
+        carts = 0
+        lines = 0
+        max_lines = 0
+        memory = 0
+        max_memory = 0
+        encodings = {}
+        # MEMORY USAGE 需要redis 4.0以上
+        try:
+            con.execute_command('MEMORY USAGE', cart_key(0))
+            memory_supported = True
+        except ResponseError:
+            memory_supported = False
+
+        for user_ids in iter_cart_user_ids():
+            pipe = con.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.hlen(cart_key(user_id))
+                pipe.object('encoding', cart_key(user_id))
+                if memory_supported:
+                    pipe.execute_command('MEMORY USAGE', cart_key(user_id))
+                    pipe.execute_command('MEMORY USAGE', cart_totals_key(user_id))
+            results = pipe.execute()
+
+            step = 4 if memory_supported else 2
+            for i in range(0, len(results), step):
+                size, encoding = results[i:i + 2]
+                if not size:
+                    # 统计期间被转存或删除
+                    continue
+                carts += 1
+                lines += size
+                max_lines = max(max_lines, size)
+                encoding = encoding.decode() if isinstance(encoding, bytes) else encoding
+                encodings[encoding] = encodings.get(encoding, 0) + 1
+                if memory_supported:
+                    cart_memory = (results[i + 2] or 0) + (results[i + 3] or 0)
+                    memory += cart_memory
+                    max_memory = max(max_memory, cart_memory)
+
+        self.stdout.write('carts in redis: %d' % carts)
+        self.stdout.write('cart lines: %d, avg %.1f, max %d' % (lines, lines / carts if carts else 0, max_lines))
+        self.stdout.write('encodings: %s' % ', '.join('%s=%d' % item for item in sorted(encodings.items())))
+        if memory_supported:
+            self.stdout.write('memory (cart + totals): %d bytes, avg %.1f, max %d'
+                              % (memory, memory / carts if carts else 0, max_memory))
+        else:
+            self.stdout.write('memory: MEMORY USAGE is not supported by this redis server')
+        self.stdout.write('archived carts in mysql: %d (%d lines)'
+                          % (CartArchive.objects.values('user').distinct().count(), CartArchive.objects.count()))
@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+from utils.user_store import get_user_store, user_store_key
+
+# 需要迁移的用户数据: 购物车、购物车统计、转存标记、浏览记录; 商品库存镜像会按需从数据库重新加载，不迁移
+USER_KEY_PATTERNS = ('cart_*', 'history_*')
+
+
+class Command(BaseCommand):
+    """将缓存redis中的购物车、浏览记录迁移到用户数据redis: python manage.py migrate_user_store
+
+    先部署使用新存储的代码再迁移，新存储中已经存在的键是迁移期间用户新写入的，默认不覆盖
+    """
+    help = '将购物车、浏览记录从缓存redis迁移到 USER_STORE_ALIAS 配置的redis，键添加 USER_STORE_KEY_PREFIX 前缀'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='default', help='原来保存用户数据的缓存配置名')
+        parser.add_argument('--replace', action='store_true', help='覆盖新存储中已存在的键')
+        parser.add_argument('--delete', action='store_true', help='迁移后删除原来的键')
+        parser.add_argument('--dry-run', action='store_true', help='只统计要迁移的键')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        source = get_redis_connection(options['source'])
+        target = get_user_store()
+        self.check_eviction_policy(target)
+
+        migrated = skipped = 0
+        for pattern in USER_KEY_PATTERNS:
+            keys = []
+            for key in source.scan_iter(match=pattern, count=options['batch_size']):
+                keys.append(key)
+                if len(keys) >= options['batch_size']:
+                    done, skip = self.migrate(source, target, keys, options)
+                    migrated, skipped, keys = migrated + done, skipped + skip, []
+            if keys:
+                done, skip = self.migrate(source, target, keys, options)
+                migrated, skipped = migrated + done, skipped + skip
+
+        action = 'would migrate' if options['dry_run'] else 'migrated'
+        self.stdout.write('%s %d keys, skipped %d existing keys' % (action, migrated, skipped))
+
+    def migrate(self, source, target, keys, options):
+        """用 DUMP/RESTORE 迁移一批键，保留剩余的过期时间，返回 迁移数, 跳过数"""
+        pipe = source.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+
+        if options['dry_run']:
+            return len([value for value in results[::2] if value is not None]), 0
+
+        pipe = target.pipeline(transaction=False)
+        restored = []
+        for key, value, pttl in zip(keys, results[::2], results[1::2]):
+            if value is None:
+                # 迁移期间过期或被删除
+                continue
+            new_key = user_store_key(key.decode())
+            # 没有过期时间时 pttl 为 -1，RESTORE 的过期时间为0表示不过期
+            ttl = max(pttl, 0)
+            if options['replace']:
+                pipe.execute_command('RESTORE', new_key, ttl, value, 'REPLACE')
+            else:
+                pipe.execute_command('RESTORE', new_key, ttl, value)
+            restored.append(key)
+
+        migrated = []
+        skipped = 0
+        for key, result in zip(restored, pipe.execute(raise_on_error=False)):
+            if isinstance(result, ResponseError):
+                # BUSYKEY: 新存储中已存在
+                skipped += 1
+            else:
+                migrated.append(key)
+
+        if options['delete'] and migrated:
+            source.delete(*migrated)
+        return len(migrated), skipped
+
+    def check_eviction_policy(self, target):
+        """用户数据不能被淘汰，提示未配置 noeviction 的情况"""
+        try:
+            policy = target.config_get('maxmemory-policy').get('maxmemory-policy')
+        except ResponseError:
+            # 云redis可能禁用了CONFIG命令
+            return
+        if policy != 'noeviction':
+            self.stderr.write('warning: maxmemory-policy of %s is %s, user carts may be evicted, use noeviction'
+                              % (settings.USER_STORE_ALIAS, policy))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('goods', '0002_goodssku_comment_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('create_time', models.DateTimeField(verbose_name='创建时间', auto_now_add=True)),
+                ('up_time', models.DateTimeField(verbose_name='修改时间', auto_now=True)),
+                ('id_delete', models.BooleanField(verbose_name='删除标记', default=False)),
+                ('count', models.IntegerField(verbose_name='商品数目', default=1)),
+                ('sku', models.ForeignKey(verbose_name='商品SKU', to='goods.GoodsSKU')),
+                ('user', models.ForeignKey(verbose_name='用户', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '转存购物车',
+                'verbose_name_plural': '转存购物车',
+                'db_table': 'df_cart_archive',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cartarchive',
+            unique_together=set([('user', 'sku')]),
+        ),
+    ]
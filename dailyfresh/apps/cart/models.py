@@ -1,3 +1,16 @@
 from django.db import models
-
+from db.base_model import BaseModel
 # Create your models here.
+
+
+class CartArchive(BaseModel):
+    '''长时间未访问、从redis转存到数据库的购物车商品'''
+    user = models.ForeignKey('user.User', verbose_name='用户')
+    sku = models.ForeignKey('goods.GoodsSKU', verbose_name='商品SKU')
+    count = models.IntegerField(default=1, verbose_name='商品数目')
+
+    class Meta:
+        db_table = 'df_cart_archive'
+        verbose_name = '转存购物车'
+        verbose_name_plural = verbose_name
+        unique_together = ('user', 'sku')
@@ -0,0 +1,466 @@
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import WatchError
+from goods.models import GoodsSKU
+from cart.models import CartArchive
+from utils.user_store import get_user_store, user_store_key, user_store_script
+
+# 购物车操作的结果
+CART_OK = 0
+CART_NO_MIRROR = -1  # redis中没有商品库存镜像，需要从数据库加载
+CART_ARCHIVED = -2  # 购物车已转存到数据库，需要先恢复到redis
+CART_NOT_FOUND = 1  # 商品不存在
+CART_OFFLINE = 2  # 商品已下线
+CART_NO_STOCK = 3  # 商品库存不足
+CART_FULL = 4  # 购物车商品条目数达到上限
+
+# 商品库存镜像过期时间(秒)，镜像与数据库不一致时最多持续这么久
+SKU_STOCK_TTL = 3600 * 24
+
+# 购物车脚本的公共部分: KEYS[1] 为购物车, KEYS[2] 为购物车统计(商品总件数count, 商品条目数lines),
+# KEYS[3] 为购物车已转存到数据库的标记; 登陆用户与未登陆用户的购物车使用相同的脚本
+# 统计随每次修改增量维护，读取时不再遍历购物车; 每次访问都重置购物车的过期时间
+# 购物车的字段、值都是整数，条目数不超过上限时redis使用紧凑的listpack(ziplist)编码保存
+_CART_COMMON = """
+local cart_ttl = %d
+local max_lines = %d
+-- 未登陆用户的购物车只短期保存
+if string.find(KEYS[1], 'cart_anon_', 1, true) then
+    cart_ttl = %d
+end
+
+if redis.call('exists', KEYS[3]) == 1 then
+    return {-2, 0, 0}
+end
+
+-- 统计不存在时(旧的购物车)，遍历一次购物车建立统计
+if redis.call('exists', KEYS[2]) == 0 then
+    local vals = redis.call('hvals', KEYS[1])
+    local total = 0
+    for _, val in ipairs(vals) do
+        total = total + tonumber(val)
+    end
+    redis.call('hmset', KEYS[2], 'count', total, 'lines', #vals)
+end
+
+-- 校验商品库存镜像，返回结果
+local function check_sku(stock_key, count)
+    local stock = redis.call('hget', stock_key, 'stock')
+    if not stock then
+        return -1
+    end
+    if redis.call('hget', stock_key, 'status') ~= '1' then
+        return 2
+    end
+    if count > tonumber(stock) then
+        return 3
+    end
+    return 0
+end
+
+-- 添加新的商品条目是否会超过上限
+local function is_full(sku_id)
+    return redis.call('hexists', KEYS[1], sku_id) == 0
+        and tonumber(redis.call('hget', KEYS[2], 'lines')) >= max_lines
+end
+
+-- 设置购物车中商品的数量，数量为0时删除，同时更新统计
+local function set_count(sku_id, count)
+    local old = tonumber(redis.call('hget', KEYS[1], sku_id) or 0)
+    if count > 0 then
+        redis.call('hset', KEYS[1], sku_id, count)
+        if old == 0 then
+            redis.call('hincrby', KEYS[2], 'lines', 1)
+        end
+    elseif old > 0 then
+        redis.call('hdel', KEYS[1], sku_id)
+        redis.call('hincrby', KEYS[2], 'lines', -1)
+    end
+    redis.call('hincrby', KEYS[2], 'count', count - old)
+end
+
+-- 刷新过期时间，返回 结果, 商品总件数, 商品条目数
+local function result(res)
+    redis.call('expire', KEYS[1], cart_ttl)
+    redis.call('expire', KEYS[2], cart_ttl)
+    local totals = redis.call('hmget', KEYS[2], 'count', 'lines')
+    return {res, tonumber(totals[1]), tonumber(totals[2])}
+end
+""" % (settings.CART_TTL, settings.CART_MAX_LINES, settings.ANON_CART_TTL)
+
+# 添加购物车: KEYS 购物车, 统计, 转存标记, 商品库存镜像; ARGV 商品id, 添加的数量
+CART_ADD_LUA = _CART_COMMON + """
+local count = tonumber(ARGV[2]) + tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0)
+local res = check_sku(KEYS[4], count)
+if res == 0 and is_full(ARGV[1]) then
+    res = 4
+end
+if res == 0 then
+    set_count(ARGV[1], count)
+end
+return result(res)
+"""
+
+# 更新购物车商品数量: KEYS 购物车, 统计, 转存标记, 商品库存镜像; ARGV 商品id, 新的数量
+CART_UPDATE_LUA = _CART_COMMON + """
+local count = tonumber(ARGV[2])
+local res = check_sku(KEYS[4], count)
+if res == 0 and is_full(ARGV[1]) then
+    res = 4
+end
+if res == 0 then
+    set_count(ARGV[1], count)
+end
+return result(res)
+"""
+
+# 删除购物车商品: KEYS 购物车, 统计, 转存标记; ARGV 商品id列表
+CART_REMOVE_LUA = _CART_COMMON + """
+for _, sku_id in ipairs(ARGV) do
+    set_count(sku_id, 0)
+end
+return result(0)
+"""
+
+# 批量修改购物车: KEYS 购物车, 统计, 转存标记, 各商品的库存镜像; ARGV 商品id, 数量, 商品id, 数量...(数量为0表示删除)
+# 先校验全部商品及修改后的条目数，有一个不通过则都不修改; 返回值最后附加未通过校验的商品id
+CART_BATCH_LUA = _CART_COMMON + """
+local final = {}
+for i = 1, #ARGV, 2 do
+    final[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+local lines = tonumber(redis.call('hget', KEYS[2], 'lines'))
+for sku_id, count in pairs(final) do
+    local exists = redis.call('hexists', KEYS[1], sku_id) == 1
+    if count > 0 and not exists then
+        lines = lines + 1
+    elseif count == 0 and exists then
+        lines = lines - 1
+    end
+end
+if lines > max_lines then
+    return result(4)
+end
+for i = 1, #ARGV, 2 do
+    local count = tonumber(ARGV[i + 1])
+    if count > 0 then
+        local res = check_sku(KEYS[3 + (i + 1) / 2], count)
+        if res ~= 0 then
+            local ret = result(res)
+            table.insert(ret, ARGV[i])
+            return ret
+        end
+    end
+end
+for i = 1, #ARGV, 2 do
+    set_count(ARGV[i], tonumber(ARGV[i + 1]))
+end
+return result(0)
+"""
+
+# 读取购物车统计: KEYS 购物车, 统计, 转存标记
+CART_TOTALS_LUA = _CART_COMMON + """
+return result(0)
+"""
+
+# 读取购物车商品: KEYS 购物车, 统计, 转存标记; ARGV 商品id列表，为空时读取全部商品
+# 返回值最后附加 商品数量列表(与ARGV对应) 或 全部的 商品id, 数量...
+CART_ITEMS_LUA = _CART_COMMON + """
+local ret = result(0)
+if #ARGV > 0 then
+    table.insert(ret, redis.call('hmget', KEYS[1], unpack(ARGV)))
+else
+    table.insert(ret, redis.call('hgetall', KEYS[1]))
+end
+return ret
+"""
+
+# 合并未登陆时的购物车: KEYS 购物车, 统计, 转存标记, 未登陆的购物车, 未登陆的购物车统计
+# 相同商品的数量相加，超过条目数上限的商品不再添加，合并后删除未登陆的购物车
+CART_MERGE_LUA = _CART_COMMON + """
+local items = redis.call('hgetall', KEYS[4])
+for i = 1, #items, 2 do
+    local sku_id = items[i]
+    if not is_full(sku_id) then
+        set_count(sku_id, tonumber(items[i + 1]) + tonumber(redis.call('hget', KEYS[1], sku_id) or 0))
+    end
+end
+redis.call('del', KEYS[4], KEYS[5])
+return result(0)
+"""
+
+# 恢复转存的购物车: KEYS 购物车, 统计, 转存标记; ARGV 商品id, 数量...
+# 只有删除转存标记成功的请求写入，并发恢复时不会重复写入或覆盖之后的修改
+CART_RESTORE_LUA = """
+if redis.call('del', KEYS[3]) == 0 then
+    return 0
+end
+local total = 0
+for i = 1, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+    total = total + tonumber(ARGV[i + 1])
+end
+redis.call('hmset', KEYS[2], 'count', total, 'lines', #ARGV / 2)
+redis.call('expire', KEYS[1], %d)
+redis.call('expire', KEYS[2], %d)
+return 1
+""" % (settings.CART_TTL, settings.CART_TTL)
+
+def get_cart_connection():
+    """购物车、商品库存镜像所在的redis连接，脚本要求它们在同一个redis中"""
+    return get_user_store()
+
+
+def _script(lua):
+    """注册lua脚本，之后通过EVALSHA调用"""
+    return user_store_script(lua)
+
+
+def get_cart_id(request, create=True):
+    """当前请求的购物车id: 登陆用户为用户id，未登陆用户为 'anon_<session_key>'
+
+    未登陆且还没有session时，create为True则创建session，否则返回None
+    """
+    if request.user.is_authenticated():
+        return request.user.id
+    if request.session.session_key is None:
+        if not create:
+            return None
+        # save() 不会标记session已修改，写入标记使 SessionMiddleware 在响应中设置session cookie，
+        # 否则每次请求都会使用新的session和空的购物车
+        request.session['anon_cart'] = True
+        request.session.save()
+    return 'anon_%s' % request.session.session_key
+
+
+def cart_key(user_id):
+    """用户购物车的键, user_id 也可以是未登陆用户的购物车id"""
+    return user_store_key('cart_%s' % user_id)
+
+
+def cart_totals_key(user_id):
+    """用户购物车统计的键"""
+    return user_store_key('cart_total_%s' % user_id)
+
+
+def cart_archived_key(user_id):
+    """购物车已转存到数据库的标记"""
+    return user_store_key('cart_archived_%s' % user_id)
+
+
+def _cart_keys(user_id):
+    """购物车脚本公共的键: 购物车, 统计, 转存标记"""
+    return [cart_key(user_id), cart_totals_key(user_id), cart_archived_key(user_id)]
+
+
+def sku_stock_key(sku_id):
+    """商品库存镜像的键"""
+    return user_store_key('sku_stock_%s' % sku_id)
+
+
+def sync_sku_stock(skus):
+    """将商品的库存、状态写入redis镜像，购物车操作不再查询数据库"""
+    pipe = get_cart_connection().pipeline(transaction=False)
+    for sku in skus:
+        pipe.hmset(sku_stock_key(sku.id), {'stock': sku.stock, 'status': sku.status})
+        pipe.expire(sku_stock_key(sku.id), SKU_STOCK_TTL)
+    pipe.execute()
+
+
+def delete_sku_stock(*sku_ids):
+    """商品删除时删除库存镜像，下次购物车操作时从数据库重新加载"""
+    get_cart_connection().delete(*[sku_stock_key(sku_id) for sku_id in sku_ids])
+
+
+# 修改库存镜像中的库存: KEYS 各商品的库存镜像; ARGV 各商品库存的变化量
+# 镜像不存在时不创建，下次购物车操作时从数据库加载
+SKU_STOCK_INCR_LUA = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        redis.call('hincrby', key, 'stock', ARGV[i])
+    end
+end
+return 0
+"""
+
+
+def incr_sku_stock(changes):
+    """下单、取消、结算用 update 修改库存后(不触发 post_save)，同步修改库存镜像, changes: {商品id: 库存变化量}
+
+    只修改镜像中的库存，热点商品的购物车操作不用回到数据库重新加载
+    """
+    sku_ids = [sku_id for sku_id, change in changes.items() if change]
+    if sku_ids:
+        _script(SKU_STOCK_INCR_LUA)(keys=[sku_stock_key(sku_id) for sku_id in sku_ids],
+                                    args=[changes[sku_id] for sku_id in sku_ids])
+
+
+def _load_sku_stock(sku_ids):
+    """从数据库加载商品库存镜像，返回是否所有商品都存在"""
+    try:
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+    except (TypeError, ValueError):
+        return False
+    skus = list(GoodsSKU.objects.filter(id__in=sku_ids).only('id', 'stock', 'status'))
+    if skus:
+        sync_sku_stock(skus)
+    return len(skus) == len(set(sku_ids))
+
+
+def _run(lua, user_id, args, sku_ids=(), keys=()):
+    """执行购物车脚本，keys 为购物车公共键之后附加的键
+
+    购物车已转存时先恢复，商品库存镜像不存在时从数据库加载，然后重试
+    返回 结果, 购物车商品总件数, 购物车商品条目数(, 脚本附加的返回值)
+    """
+    keys = _cart_keys(user_id) + list(keys)
+    ret = _script(lua)(keys=keys, args=args)
+    if ret[0] == CART_ARCHIVED:
+        restore_cart(user_id)
+        ret = _script(lua)(keys=keys, args=args)
+    if ret[0] == CART_NO_MIRROR:
+        if not _load_sku_stock(sku_ids):
+            return [CART_NOT_FOUND] + ret[1:]
+        ret = _script(lua)(keys=keys, args=args)
+    return ret
+
+
+def cart_add(user_id, sku_id, count):
+    """添加商品到购物车，返回 结果, 购物车商品总件数, 购物车商品条目数"""
+    return _run(CART_ADD_LUA, user_id, [sku_id, count], [sku_id], [sku_stock_key(sku_id)])
+
+
+def cart_update(user_id, sku_id, count):
+    """更新购物车中商品的数量，返回 结果, 购物车商品总件数, 购物车商品条目数"""
+    return _run(CART_UPDATE_LUA, user_id, [sku_id, count], [sku_id], [sku_stock_key(sku_id)])
+
+
+def cart_batch(user_id, ops):
+    """在一个脚本中批量修改购物车, ops: [(商品id, 数量)]，数量为0表示删除
+
+    全部成功或全部不修改，返回 结果, 购物车商品总件数, 购物车商品条目数, 失败时附加未通过校验的商品id
+    """
+    args = []
+    for sku_id, count in ops:
+        args.extend([sku_id, count])
+    return _run(CART_BATCH_LUA, user_id, args,
+                [sku_id for sku_id, count in ops if count > 0],
+                [sku_stock_key(sku_id) for sku_id, count in ops])
+
+
+def cart_remove(user_id, sku_ids):
+    """删除购物车中的商品，返回 购物车商品总件数, 购物车商品条目数"""
+    res, count, lines = _run(CART_REMOVE_LUA, user_id, sku_ids)
+    return count, lines
+
+
+def cart_totals(user_id, client=None):
+    """读取购物车统计 [结果, 商品总件数, 商品条目数]
+
+    client 可以是pipeline，结果在pipeline执行时返回，结果为 CART_ARCHIVED 时需要调用者不传client再读取一次
+    """
+    if client is not None:
+        return _script(CART_TOTALS_LUA)(keys=_cart_keys(user_id), client=client)
+    return _run(CART_TOTALS_LUA, user_id, [])
+
+
+def cart_items(user_id):
+    """读取购物车中的全部商品 {商品id: 数量}"""
+    items = _run(CART_ITEMS_LUA, user_id, [])[3]
+    return {int(items[i]): int(items[i + 1]) for i in range(0, len(items), 2)}
+
+
+def cart_counts(user_id, sku_ids):
+    """读取购物车中这些商品的数量，与sku_ids一一对应，不在购物车中的商品为None"""
+    if not sku_ids:
+        return []
+    counts = _run(CART_ITEMS_LUA, user_id, list(sku_ids))[3]
+    return [None if count is None else int(count) for count in counts]
+
+
+def cart_merge(user_id, anon_id):
+    """登陆时在一个脚本中将未登陆时的购物车合并到用户购物车，返回 购物车商品总件数, 购物车商品条目数"""
+    res, count, lines = _run(CART_MERGE_LUA, user_id, [], keys=[cart_key(anon_id), cart_totals_key(anon_id)])
+    return count, lines
+
+
+def restore_cart(user_id):
+    """将转存到数据库的购物车恢复到redis"""
+    items = CartArchive.objects.filter(user_id=user_id).values_list('sku_id', 'count')
+    args = []
+    for sku_id, count in items:
+        args.extend([sku_id, count])
+    if _script(CART_RESTORE_LUA)(keys=_cart_keys(user_id), args=args):
+        CartArchive.objects.filter(user_id=user_id).delete()
+
+
+def archive_cart(user_id):
+    """将购物车转存到数据库并从redis删除，返回是否转存
+
+    先写入数据库再删除redis中的购物车，转存期间购物车被修改时放弃本次转存
+    """
+    key = cart_key(user_id)
+    with get_cart_connection().pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            cart = {int(sku_id): int(count) for sku_id, count in pipe.hgetall(key).items()}
+            if not cart:
+                return False
+            # 已删除的商品不再保存
+            sku_ids = GoodsSKU.objects.filter(id__in=cart.keys()).values_list('id', flat=True)
+            with transaction.atomic():
+                CartArchive.objects.filter(user_id=user_id).delete()
+                CartArchive.objects.bulk_create([CartArchive(user_id=user_id, sku_id=sku_id, count=cart[sku_id])
+                                                 for sku_id in sku_ids])
+            pipe.multi()
+            pipe.set(cart_archived_key(user_id), 1)
+            pipe.delete(key, cart_totals_key(user_id))
+            pipe.execute()
+        except WatchError:
+            # 购物车被修改，不再空闲
+            CartArchive.objects.filter(user_id=user_id).delete()
+            return False
+    return True
+
+
+def _cart_user_id(key):
+    """从键中取出用户购物车的用户id，不是用户购物车的键返回None"""
+    if isinstance(key, bytes):
+        key = key.decode()
+    user_id = key[len(user_store_key('cart_')):]
+    return int(user_id) if user_id.isdigit() else None
+
+
+def iter_cart_user_ids(batch_size=1000):
+    """遍历redis中所有用户购物车的用户id，每次返回一批"""
+    user_ids = []
+    for key in get_cart_connection().scan_iter(match=user_store_key('cart_*'), count=batch_size):
+        user_id = _cart_user_id(key)
+        if user_id is not None:
+            user_ids.append(user_id)
+        if len(user_ids) >= batch_size:
+            yield user_ids
+            user_ids = []
+    if user_ids:
+        yield user_ids
+
+
+def archive_idle_carts():
+    """将空闲超过 CART_ARCHIVE_IDLE 秒的购物车转存到数据库，返回转存的数量
+
+    每次访问都会把购物车的过期时间重置为 CART_TTL，剩余时间越少空闲越久，不需要另外记录访问时间
+    """
+    con = get_cart_connection()
+    max_ttl = settings.CART_TTL - settings.CART_ARCHIVE_IDLE
+    archived = 0
+    for user_ids in iter_cart_user_ids():
+        pipe = con.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.ttl(cart_key(user_id))
+        for user_id, ttl in zip(user_ids, pipe.execute()):
+            if ttl is None or ttl == -1:
+                # 没有过期时间的旧购物车，从现在开始计算空闲时间
+                con.expire(cart_key(user_id), settings.CART_TTL)
+            elif 0 <= ttl <= max_ttl and archive_cart(user_id):
+                archived += 1
+    return archived
@@ -1,9 +1,11 @@
+import json
+
 from django.shortcuts import render
 from django.views.generic import View
 from django.http import JsonResponse
-from goods.models import GoodsSKU
-from django_redis import get_redis_connection
-from utils.mixin import LoginRequiredMixin
+from goods.utils import get_skus
+from cart.utils import cart_add, cart_update, cart_remove, cart_batch, cart_items, get_cart_id, \
+    CART_OK, CART_NOT_FOUND, CART_OFFLINE, CART_NO_STOCK, CART_FULL
 from django.conf import settings
 # Create your views here.
 
@@ -14,10 +16,8 @@ class CartAddView(View):
     def post(self, request):
         """通过ajax的post方式发送数据"""
         # 1.获取数据
-        user = request.user
-        # 未登陆无法操作
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登陆'})
+        # 未登陆时使用按session保存的购物车，登陆时合并
+        cart_id = get_cart_id(request)
 
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
@@ -27,47 +27,46 @@ class CartAddView(View):
         if not all([sku_id, count]):
 
             return JsonResponse({'res': 1, 'errmsg':'数据不完整'})
+        # 商品id转为整数，与库存镜像、购物车中的键一致
+        try:
+            sku_id = int(sku_id)
+        except ValueError:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
         # 校验数量
         try:
             count = int(count)
         except Exception as e:
             return JsonResponse({'res': 2, 'errmsg':'商品数目出错'})
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        if count <= 0:
+            return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
         # 3.业务处理：添加购物车记录
-        con = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 先尝试获取sku_id 的值，如果没有，hget返回none
-        cart_count = con.hget(cart_key, sku_id)
-        if cart_count:
-            count += int(cart_count)
-        # 判断库存
-        if count > sku.stock:
+        # 在redis中用脚本原子的完成：校验商品是否存在及库存(商品库存镜像)、累加数量、更新购物车统计
+        res, cart_count, total_count = cart_add(cart_id, sku_id, count)
+        if res == CART_NOT_FOUND:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        if res == CART_OFFLINE:
+            return JsonResponse({'res': 3, 'errmsg': '商品已下架'})
+        if res == CART_NO_STOCK:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
-        # 设置hash中sku_id的值，如果有就是更新，没有时添加
-        con.hset(cart_key, sku_id, count)
-        # 统计商品的条目数
-        total_count = con.hlen(cart_key)
+        if res == CART_FULL:
+            return JsonResponse({'res': 6, 'errmsg': '购物车商品种类已达上限'})
+        if res != CART_OK:
+            # 重新加载后库存镜像仍不存在(如被并发的下单删除)等情况，购物车没有修改
+            return JsonResponse({'res': 7, 'errmsg': '操作失败，请重试'})
         # 4.返回数据
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '添加成功'})
 
 
 # /cart
-class CartInfoView(LoginRequiredMixin, View):
+class CartInfoView(View):
     """显示购物车页面"""
     def get(self, request):
         """显示"""
-        # 读取用户名
-        user = request.user
-        # 链接redis数据库
-        cart_key = 'cart_%d' % user.id
-        con = get_redis_connection('default')
-        # 获取数据，{'key':value}
-        cart_dict = con.hgetall(cart_key)
+        # 未登陆用户显示按session保存的购物车
+        cart_id = get_cart_id(request, create=False)
+        # 获取数据，{'key':value}，购物车已转存到数据库时会先恢复
+        cart_dict = cart_items(cart_id) if cart_id is not None else {}
 
         # 商品sku对象字典
         skus = []
@@ -75,9 +74,11 @@ class CartInfoView(LoginRequiredMixin, View):
         total_count = 0
         # 购物车总价格
         total_amount = 0
+        # 一次取出购物车中的所有商品,不存在或已下线的商品不显示
+        cart_skus = get_skus(cart_dict.keys(), online_only=True)
         # 便利购物车数据
-        for sku_id, count in cart_dict.items():
-            sku = GoodsSKU.objects.get(id=sku_id)
+        for sku in cart_skus:
+            count = cart_dict[sku.id]
             amount = sku.price*int(count)
             # 给sku对象动态添加amout属性，保存商品小计
             sku.amount = amount
@@ -104,10 +105,8 @@ class CartUpdateView(View):
     def post(self, request):
         """通过ajax更新信息"""
         # 1.获取数据
-        user = request.user
-        # 未登陆无法操作
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登陆'})
+        # 未登陆时使用按session保存的购物车，登陆时合并
+        cart_id = get_cart_id(request)
 
         sku_id = request.POST.get('sku_id')
         count = request.POST.get('count')
@@ -116,32 +115,33 @@ class CartUpdateView(View):
         # 校验数据完整性
         if not all([sku_id, count]):
             return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+        # 商品id转为整数，与库存镜像、购物车中的键一致
+        try:
+            sku_id = int(sku_id)
+        except ValueError:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
         # 校验数量
         try:
             count = int(count)
         except Exception as e:
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
-
-        # 3.业务处理：添加购物车记录
-        con = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        if count <= 0:
+            return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
-        # 判断库存
-        if count > sku.stock:
+        # 3.业务处理：更新购物车记录
+        # 在redis中用脚本原子的完成：校验商品是否存在及库存(商品库存镜像)、设置数量、更新购物车统计
+        res, total_count, cart_lines = cart_update(cart_id, sku_id, count)
+        if res == CART_NOT_FOUND:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        if res == CART_OFFLINE:
+            return JsonResponse({'res': 3, 'errmsg': '商品已下架'})
+        if res == CART_NO_STOCK:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
-        # 设置hash中sku_id的值，如果有就是更新，没有时添加
-        con.hset(cart_key, sku_id, count)
-
-        # 获取购物车中总数量
-        total_count = 0
-        vals = con.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        if res == CART_FULL:
+            return JsonResponse({'res': 6, 'errmsg': '购物车商品种类已达上限'})
+        if res != CART_OK:
+            # 重新加载后库存镜像仍不存在(如被并发的下单删除)等情况，购物车没有修改
+            return JsonResponse({'res': 7, 'errmsg': '操作失败，请重试'})
 
         # 4.返回数据
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '添加成功'})
@@ -153,34 +153,67 @@ class CartDeleteView(View):
     def post(self, request):
         # 通过ajax传递数据，post
         # 1.获取数据
-        user = request.user
-        # 未登陆无法操作
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登陆'})
+        # 未登陆时使用按session保存的购物车，登陆时合并
+        cart_id = get_cart_id(request)
 
         sku_id = request.POST.get('sku_id')
         # 2.校验数据
         if not sku_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的商品id'})
 
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
+        # 业务处理，删除数据,并获取购物车中总数量
+        total_count, cart_lines = cart_remove(cart_id, [sku_id])
 
-        # 业务处理，删除数据
-        con = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 删除
-        con.hdel(cart_key, sku_id)
+        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
 
-        # 获取购物车中总数量
-        total_count = 0
-        vals = con.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
 
-        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
+# /cart/batch
+class CartBatchView(View):
+    """批量修改购物车，前端可以合并多次修改一次提交"""
+    def post(self, request):
+        """ops: json列表 [{"sku_id": 1, "count": 2}, {"sku_id": 3, "delete": true}]"""
+        # 1.获取数据
+        # 未登陆时使用按session保存的购物车，登陆时合并
+        cart_id = get_cart_id(request)
 
+        # 2.校验数据
+        try:
+            ops = json.loads(request.POST.get('ops', ''))
+            # 一次修改的商品数不超过购物车商品种类上限，避免过大的批量在一个redis脚本中执行
+            if len(ops) > settings.CART_MAX_LINES:
+                return JsonResponse({'res': 6, 'errmsg': '一次修改的商品过多'})
+            cart_ops = []
+            for op in ops:
+                sku_id = int(op['sku_id'])
+                count = 0 if op.get('delete') else int(op['count'])
+                if count < 0 or (count == 0 and not op.get('delete')):
+                    raise ValueError
+                cart_ops.append((sku_id, count))
+        except Exception as e:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+        if not cart_ops:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
 
+        # 一次查询校验修改数量的商品是否存在
+        sku_ids = set(sku_id for sku_id, count in cart_ops if count > 0)
+        found = set(sku.id for sku in get_skus(sku_ids))
+        if sku_ids - found:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在', 'sku_id': min(sku_ids - found)})
 
+        # 3.业务处理：在一个redis脚本中校验库存并修改，全部成功或全部不修改
+        ret = cart_batch(cart_id, cart_ops)
+        res, total_count, cart_lines = ret[:3]
+        if res == CART_NOT_FOUND:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
+        if res == CART_OFFLINE:
+            return JsonResponse({'res': 3, 'errmsg': '商品已下架', 'sku_id': int(ret[3])})
+        if res == CART_NO_STOCK:
+            return JsonResponse({'res': 4, 'errmsg': '商品库存不足', 'sku_id': int(ret[3])})
+        if res == CART_FULL:
+            return JsonResponse({'res': 6, 'errmsg': '购物车商品种类已达上限'})
+        if res != CART_OK:
+            # 重新加载后库存镜像仍不存在(如被并发的下单删除)等情况，购物车没有修改
+            return JsonResponse({'res': 7, 'errmsg': '操作失败，请重试'})
+
+        # 4.返回数据
+        return JsonResponse({'res': 5, 'total_count': total_count, 'cart_count': cart_lines, 'message': '修改成功'})
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from goods.models import GoodsType,  IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU
-from django.core.cache import cache
+from utils.cache import expire_cache
 
 # Register your models here.
 
@@ -10,20 +10,20 @@ class BaseModelAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         """新增或更新表中数据时调用"""
         super().save_model(request, obj, form, change)  # 继承父类原有操作
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()  # 生成静态页面
+        from celery_tasks.tasks import request_static_index_html
+        request_static_index_html()  # 生成静态页面,短时间内的多次修改合并为一次生成
 
-        # 首页数据改变时，清除首页数据缓存, 在请求页重新请求并设置缓存
-        cache.delete('index_page_data')
+        # 首页数据改变时，将首页数据缓存标记为陈旧, 由下一个请求重建缓存
+        expire_cache('index_page_data')
 
     def delete_model(self, request, obj):
         """删除表中数据时调用"""
         super().delete_model(request, obj)  # 继承父类原有操作
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()  # 生成静态页面
+        from celery_tasks.tasks import request_static_index_html
+        request_static_index_html()  # 生成静态页面,短时间内的多次修改合并为一次生成
 
-        # 首页数据改变时，清除首页数据缓存, 在请求页重新请求并设置缓存
-        cache.delete('index_page_data')
+        # 首页数据改变时，将首页数据缓存标记为陈旧, 由下一个请求重建缓存
+        expire_cache('index_page_data')
 
 class IndexPromotionBannerAdmin(BaseModelAdmin):
     pass
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from goods.models import GoodsType
+from goods.rank import rebuild_rank
+
+
+class Command(BaseCommand):
+    """从数据库重建商品种类的排序集合: python manage.py rebuild_goods_rank [种类id ...]"""
+    help = '从数据库重建商品列表页使用的价格、销量、上架时间排序集合'
+
+    def add_arguments(self, parser):
+        parser.add_argument('type_ids', nargs='*', type=int, help='要重建的种类id，不传则重建全部种类')
+
+    def handle(self, *args, **options):
+        type_ids = options['type_ids'] or GoodsType.objects.values_list('id', flat=True)
+        for type_id in type_ids:
+            rebuild_rank(type_id)
+            self.stdout.write('rebuilt goods rank of type %s' % type_id)
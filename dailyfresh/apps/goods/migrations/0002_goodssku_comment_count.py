@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def fill_comment_count(apps, schema_editor):
+    """统计已有的评论数量"""
+    GoodsSKU = apps.get_model('goods', 'GoodsSKU')
+    OrderGoods = apps.get_model('order', 'OrderGoods')
+    counts = OrderGoods.objects.exclude(comment__in=['', 'False']).values('sku').annotate(count=Count('id'))
+    for item in counts:
+        GoodsSKU.objects.filter(id=item['sku']).update(comment_count=item['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0001_initial'),
+        ('order', '0002_auto_20190718_1555'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='goodssku',
+            name='comment_count',
+            field=models.IntegerField(verbose_name='评论数量', default=0),
+        ),
+        migrations.RunPython(fill_comment_count, migrations.RunPython.noop),
+    ]
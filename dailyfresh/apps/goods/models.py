@@ -34,6 +34,7 @@ class GoodsSKU(BaseModel):
     image = models.ImageField(upload_to='goods', verbose_name='商品图片')
     stock = models.IntegerField(default=1, verbose_name='商品库存')
     sales = models.IntegerField(default=0, verbose_name='商品销量')
+    comment_count = models.IntegerField(default=0, verbose_name='评论数量')
     status = models.SmallIntegerField(default=1, choices=status_choices, verbose_name='商品状态')
 
     class Meta:
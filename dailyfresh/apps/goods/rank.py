@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.core.paginator import Page
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods.utils import get_skus
+from utils.paginator import CountedPaginator
+
+# 每个种类维护的排序集合: 价格、销量、上架时间
+RANK_FIELDS = ('price', 'sales', 'create_time')
+
+# 列表页排序方式: 排序集合, 是否降序
+LIST_RANKS = {
+    'price': ('price', False),
+    'hot': ('sales', True),
+    'default': ('create_time', True),
+}
+
+
+def rank_key(type_id, field):
+    """种类商品排序集合的键"""
+    return 'goods_rank_%s_%s' % (type_id, field)
+
+
+def rank_built_key(type_id):
+    """种类排序集合已建立的标记，由 rebuild_rank 设置
+
+    排序集合在可淘汰的缓存中，集合不存在时无法区分未建立和被淘汰; 没有标记时不读取也不增量更新排序集合，
+    避免增量更新重新创建只有少数商品的集合
+    """
+    return 'goods_rank_%s_built' % type_id
+
+
+def _built_types(con, type_ids):
+    """已建立排序集合的种类id"""
+    type_ids = list(set(type_ids))
+    pipe = con.pipeline(transaction=False)
+    for type_id in type_ids:
+        pipe.exists(rank_built_key(type_id))
+    return {type_id for type_id, built in zip(type_ids, pipe.execute()) if built}
+
+
+def _scores(sku):
+    """商品在各排序集合中的分值"""
+    return {
+        'price': float(sku.price),
+        'sales': sku.sales,
+        'create_time': sku.create_time.timestamp(),
+    }
+
+
+def update_sku_rank(sku, pipe=None):
+    """添加或更新商品在种类排序集合中的分值，种类的排序集合未建立时忽略"""
+    con = get_redis_connection('default')
+    if not con.exists(rank_built_key(sku.type_id)):
+        return
+    execute = pipe is None
+    if pipe is None:
+        pipe = con.pipeline(transaction=False)
+    for field, score in _scores(sku).items():
+        pipe.zadd(rank_key(sku.type_id, field), score, sku.id)
+    if execute:
+        pipe.execute()
+
+
+def remove_sku_rank(sku, type_id=None):
+    """从种类排序集合中删除商品，type_id 默认为商品当前的种类"""
+    type_id = sku.type_id if type_id is None else type_id
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for field in RANK_FIELDS:
+        pipe.zrem(rank_key(type_id, field), sku.id)
+    pipe.execute()
+
+
+def incr_sales_rank(sales):
+    """下单后增加商品的销量分值, sales: [(type_id, sku_id, 增加的销量)]，忽略排序集合未建立的种类"""
+    con = get_redis_connection('default')
+    built = _built_types(con, [type_id for type_id, sku_id, count in sales])
+    if not built:
+        return
+    pipe = con.pipeline(transaction=False)
+    for type_id, sku_id, count in sales:
+        if type_id in built:
+            pipe.zincrby(rank_key(type_id, 'sales'), sku_id, count)
+    pipe.execute()
+
+
+def get_rank_page(type, sort, page):
+    """从排序集合获取列表页某一页的商品
+
+    排序集合还未建立或已被淘汰时返回None，由调用者从数据库查询
+    返回 paginator, page_skus
+    """
+    field, desc = LIST_RANKS[sort]
+    key = rank_key(type.id, field)
+    con = get_redis_connection('default')
+    pipe = con.pipeline(transaction=False)
+    pipe.exists(rank_built_key(type.id))
+    pipe.zcard(key)
+    built, count = pipe.execute()
+    if not built or count == 0:
+        return None
+
+    paginator = CountedPaginator(key, settings.GOODS_LIST_PAGE_SIZE, count)
+    # 传入的page大于最大值
+    if page < 1 or page > paginator.num_pages:
+        page = 1
+    start = (page - 1) * paginator.per_page
+    end = start + paginator.per_page - 1
+    if desc:
+        sku_ids = con.zrevrange(key, start, end)
+    else:
+        sku_ids = con.zrange(key, start, end)
+    return paginator, Page(get_skus(sku_ids), page, paginator)
+
+
+def get_new_skus(type_id, count=2):
+    """获取种类中最新上架的商品，排序集合还未建立或已被淘汰时从数据库查询"""
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    pipe.exists(rank_built_key(type_id))
+    pipe.zrevrange(rank_key(type_id, 'create_time'), 0, count - 1)
+    built, sku_ids = pipe.execute()
+    if built and sku_ids:
+        return get_skus(sku_ids)
+    return list(GoodsSKU.objects.filter(type_id=type_id).order_by('-create_time')[:count])
+
+
+def rebuild_rank(type_id):
+    """从数据库重建一个种类的排序集合，先写入临时键再替换，重建期间读取不受影响"""
+    con = get_redis_connection('default')
+    pipe = con.pipeline(transaction=False)
+    tmp_keys = {field: rank_key(type_id, field) + '_rebuild' for field in RANK_FIELDS}
+    pipe.delete(*tmp_keys.values())
+    for sku in GoodsSKU.objects.filter(type_id=type_id).only('id', 'type', 'price', 'sales', 'create_time').iterator():
+        for field, score in _scores(sku).items():
+            pipe.zadd(tmp_keys[field], score, sku.id)
+        if len(pipe) >= 1000:
+            pipe.execute()
+    pipe.execute()
+
+    pipe = con.pipeline()
+    for field, tmp_key in tmp_keys.items():
+        if con.exists(tmp_key):
+            pipe.rename(tmp_key, rank_key(type_id, field))
+        else:
+            # 种类下没有商品
+            pipe.delete(rank_key(type_id, field))
+    pipe.set(rank_built_key(type_id), 1)
+    pipe.execute()
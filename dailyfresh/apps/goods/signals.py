@@ -0,0 +1,77 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from cart.utils import sync_sku_stock, delete_sku_stock
+from goods.models import GoodsType, GoodsSKU, Goods, GoodsImage
+from goods.rank import update_sku_rank, remove_sku_rank
+from goods.utils import GOODS_TYPES_CACHE_KEY, bump_detail_version, bump_type_detail_version, \
+    change_type_sku_count, delete_sku_cache
+from order.models import OrderGoods
+from utils.cache import catalog_cache
+
+
+@receiver([post_save, post_delete], sender=GoodsType)
+def goods_type_changed(sender, **kwargs):
+    """商品种类修改时，清除所有进程中的种类缓存"""
+    catalog_cache.invalidate(GOODS_TYPES_CACHE_KEY)
+
+
+@receiver([post_save, post_delete], sender=GoodsSKU)
+def goods_sku_changed(sender, instance, **kwargs):
+    """商品修改时，更新该商品的详情缓存版本，以及种类的详情缓存版本(同种类的新品推荐和同SPU的其他规格)"""
+    bump_detail_version([instance.id])
+    bump_type_detail_version(instance.type_id)
+
+
+@receiver(pre_save, sender=GoodsSKU)
+def goods_sku_saving(sender, instance, **kwargs):
+    """修改商品前记录原来的种类，种类变化时从原种类的排序集合中删除"""
+    instance._old_type_id = None
+    if instance.pk is not None:
+        instance._old_type_id = GoodsSKU.objects.filter(pk=instance.pk).values_list('type_id', flat=True).first()
+
+
+@receiver(post_save, sender=GoodsSKU)
+def goods_sku_saved(sender, instance, created, **kwargs):
+    """添加商品时，种类商品数量加1; 修改种类时原种类减1、新种类加1; 更新商品排序集合、缓存及库存镜像"""
+    if created:
+        change_type_sku_count(instance.type_id, 1)
+    old_type_id = getattr(instance, '_old_type_id', None)
+    if old_type_id is not None and old_type_id != instance.type_id:
+        change_type_sku_count(old_type_id, -1)
+        change_type_sku_count(instance.type_id, 1)
+        remove_sku_rank(instance, old_type_id)
+        # 原种类商品详情页中的新品推荐也随之变化
+        bump_type_detail_version(old_type_id)
+    update_sku_rank(instance)
+    delete_sku_cache(instance.id)
+    # 更新购物车使用的商品库存镜像
+    sync_sku_stock([instance])
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def goods_sku_deleted(sender, instance, **kwargs):
+    """删除商品时，种类商品数量减1，并删除商品的排序集合、缓存及库存镜像"""
+    change_type_sku_count(instance.type_id, -1)
+    remove_sku_rank(instance)
+    delete_sku_cache(instance.id)
+    delete_sku_stock(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Goods)
+def goods_changed(sender, instance, **kwargs):
+    """商品SPU修改时，更新该SPU下所有商品的详情缓存版本"""
+    bump_detail_version(GoodsSKU.objects.filter(goods=instance).values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=GoodsImage)
+def goods_image_changed(sender, instance, **kwargs):
+    """商品图片修改时，更新该商品的详情缓存版本"""
+    bump_detail_version([instance.sku_id])
+
+
+@receiver(post_save, sender=OrderGoods)
+def order_goods_commented(sender, instance, **kwargs):
+    """订单商品评论后，更新该商品的详情缓存版本"""
+    # 未评论时comment为空或默认值'False'
+    if instance.comment and instance.comment != 'False':
+        bump_detail_version([instance.sku_id])
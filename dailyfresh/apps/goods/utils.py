@@ -0,0 +1,282 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Page
+from django.db.models import Q
+from goods.models import GoodsType, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from order.models import OrderGoods
+from utils.cache import catalog_cache
+from utils.paginator import CountedPaginator
+
+# 商品种类缓存的键
+GOODS_TYPES_CACHE_KEY = 'goods_types'
+
+
+def get_goods_types():
+    """获取商品的全部种类信息，种类很少修改，使用两级缓存"""
+    return catalog_cache.get(GOODS_TYPES_CACHE_KEY, lambda: list(GoodsType.objects.all()), 3600 * 24)
+
+
+def _sku_cache_key(sku_id):
+    """单个商品缓存的键"""
+    return 'goods_sku_%s' % sku_id
+
+
+def get_skus(sku_ids, online_only=False):
+    """按sku_ids的顺序批量获取商品
+
+    先从缓存批量读取，缓存中没有的商品一次查询取出后写入缓存(过期时间较短，库存等数据允许短暂不一致)。
+    不存在的商品跳过，online_only为True时下线的商品也跳过。
+    """
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return []
+
+    cached = cache.get_many([_sku_cache_key(sku_id) for sku_id in sku_ids])
+    skus = {}
+    missing = []
+    for sku_id in sku_ids:
+        sku = cached.get(_sku_cache_key(sku_id))
+        if sku is None:
+            missing.append(sku_id)
+        else:
+            skus[sku_id] = sku
+
+    if missing:
+        found = GoodsSKU.objects.in_bulk(missing)
+        cache.set_many({_sku_cache_key(sku_id): sku for sku_id, sku in found.items()}, settings.SKU_CACHE_TTL)
+        skus.update(found)
+
+    return [skus[sku_id] for sku_id in sku_ids
+            if sku_id in skus and (not online_only or skus[sku_id].status == 1)]
+
+
+def delete_sku_cache(*sku_ids):
+    """商品修改时删除商品的缓存"""
+    cache.delete_many([_sku_cache_key(sku_id) for sku_id in sku_ids])
+
+
+def get_index_page_data():
+    """获取首页数据，IndexView 与生成静态首页的任务共用
+
+    无论有多少商品种类，固定只需4次查询：
+    种类、轮播商品、促销活动各一次，分类展示商品一次查出后在python中按种类分组
+    """
+    # 获取商品的种类信息
+    types = list(GoodsType.objects.all())
+    # 获取首页轮播商品信息,连带查出sku,模板中访问banner.sku不再查询
+    goods_banner = list(IndexGoodsBanner.objects.select_related('sku').order_by('index'))
+    # 获取首页促销活动信息
+    promotion_banner = list(IndexPromotionBanner.objects.all().order_by('index'))
+
+    # 获取首页分类商品展示信息,一次查出所有种类的展示商品
+    type_banners = IndexTypeGoodsBanner.objects.select_related('sku').order_by('index')
+
+    # 按 种类id 分组, display_type: 1 图片展示, 0 文字展示
+    image_banners = {}
+    title_banners = {}
+    for banner in type_banners:
+        if banner.display_type == 1:
+            image_banners.setdefault(banner.type_id, []).append(banner)
+        else:
+            title_banners.setdefault(banner.type_id, []).append(banner)
+
+    for type in types:
+        # python 可以动态的给对象添加属性
+        type.image_banner = image_banners.get(type.id, [])
+        type.title_banner = title_banners.get(type.id, [])
+
+    content = {
+        'types': types,
+        'goods_banner': goods_banner,
+        'promotion_banner': promotion_banner,
+        'nginx_url': settings.FDFS_NGINX_URL,
+    }
+    return content
+
+
+def _detail_version_key(sku_id):
+    """商品详情缓存版本号的键"""
+    return 'goods_detail_version_%s' % sku_id
+
+
+def get_detail_version(sku_id):
+    """获取商品详情缓存的版本号"""
+    version = cache.get(_detail_version_key(sku_id))
+    if version is None:
+        # 版本号不存在或被淘汰，使用当前时间作为新版本号，不会与旧版本的缓存冲突
+        version = int(time.time() * 1000)
+        if not cache.add(_detail_version_key(sku_id), version, None):
+            version = cache.get(_detail_version_key(sku_id), version)
+    return version
+
+
+def bump_detail_version(sku_ids):
+    """更新商品详情缓存的版本号，旧版本的缓存不再被读取，等待自然过期"""
+    version = int(time.time() * 1000)
+    cache.set_many({_detail_version_key(sku_id): version for sku_id in sku_ids}, None)
+
+
+def _type_detail_version_key(type_id):
+    """种类商品详情缓存版本号的键，详情页中的新品推荐和其他规格随种类中的商品变化"""
+    return 'goods_type_detail_version_%s' % type_id
+
+
+def get_type_detail_version(type_id):
+    """获取种类商品详情缓存的版本号"""
+    version = cache.get(_type_detail_version_key(type_id))
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(_type_detail_version_key(type_id), version, None):
+            version = cache.get(_type_detail_version_key(type_id), version)
+    return version
+
+
+def bump_type_detail_version(type_id):
+    """更新种类商品详情缓存的版本号，种类中所有商品的详情缓存失效，代价与种类中的商品数无关"""
+    cache.set(_type_detail_version_key(type_id), int(time.time() * 1000), None)
+
+
+def get_comments(sku_id, page):
+    """获取商品第page页的评论, 返回 评论列表, 是否还有下一页"""
+    per_page = settings.GOODS_COMMENT_PAGE_SIZE
+    start = (page - 1) * per_page
+    # 排除没有评论订单,未评论时comment为空或默认值'False'; 多取一条用于判断是否有下一页
+    comments = list(OrderGoods.objects.filter(sku_id=sku_id)
+                    .exclude(comment__in=['', 'False'])
+                    .select_related('order__user')
+                    .order_by('-up_time')[start:start + per_page + 1])
+    return comments[:per_page], len(comments) > per_page
+
+
+def get_detail_data(sku_id):
+    """获取商品详情页中与用户无关的数据，按商品和版本号缓存
+
+    缓存中记录生成时种类的版本号，种类版本号变化(新品推荐或其他规格变化)后重新生成;
+    商品不存在时返回None
+    """
+    key = 'goods_detail_%s_%s' % (sku_id, get_detail_version(sku_id))
+    data = cache.get(key)
+    if data is not None and data.get('type_version') == get_type_detail_version(data['sku'].type_id):
+        return data
+
+    try:
+        sku = GoodsSKU.objects.select_related('type', 'goods').get(id=sku_id)
+    except GoodsSKU.DoesNotExist:
+        return None
+
+    from goods.rank import get_new_skus  # rank 模块依赖本模块，在函数中导入避免循环导入
+
+    # 获取第一页评论信息,之后的评论通过ajax分页获取
+    sku_order, has_more_comments = get_comments(sku.id, 1)
+    data = {
+        'type_version': get_type_detail_version(sku.type_id),
+        'sku': sku,
+        'sku_order': sku_order,
+        'has_more_comments': has_more_comments,
+        # 获取新品推荐,从sku中获取对应类型的商品，并按照时间降序,取前两个
+        'new_skus': get_new_skus(sku.type_id),
+        # 获取同一个SPU其他规格的商品信息
+        'same_spu_sku': list(GoodsSKU.objects.filter(goods=sku.goods).exclude(id=sku.id)),
+    }
+    cache.set(key, data, settings.DETAIL_CACHE_TTL)
+    return data
+
+
+def _type_sku_count_key(type_id):
+    """种类商品数量缓存的键"""
+    return 'goods_type_sku_count_%s' % type_id
+
+
+def get_type_sku_count(type_id):
+    """获取种类下的商品数量，缓存后由商品的添加、删除、修改种类维护，过期后从数据库重新统计"""
+    count = cache.get(_type_sku_count_key(type_id))
+    if count is None:
+        count = GoodsSKU.objects.filter(type_id=type_id).count()
+        cache.add(_type_sku_count_key(type_id), count, settings.TYPE_SKU_COUNT_TTL)
+    return count
+
+
+def change_type_sku_count(type_id, delta):
+    """商品添加、删除或修改种类时更新种类商品数量的缓存"""
+    try:
+        cache.incr(_type_sku_count_key(type_id), delta)
+    except ValueError:
+        # 缓存不存在，下次读取时重新统计
+        pass
+
+
+# 列表页排序方式: 排序字段, 是否升序; 排序字段相同时按id同方向排序
+LIST_SORTS = {
+    'price': ('price', True),
+    'hot': ('sales', False),
+    'default': ('id', False),
+}
+
+
+def _encode_cursor(sku, field):
+    """游标: 排序字段的值_商品id"""
+    return '%s_%s' % (getattr(sku, field), sku.id)
+
+
+def _keyset_filter(field, asc, cursor, forward):
+    """返回游标之后(forward)或之前的查询条件，游标不合法时返回None"""
+    try:
+        value, sku_id = cursor.rsplit('_', 1)
+        sku_id = int(sku_id)
+        value = GoodsSKU._meta.get_field(field).to_python(value)
+    except Exception:
+        return None
+
+    # 升序向后翻页或降序向前翻页，取比游标大的记录
+    op = 'gt' if asc == forward else 'lt'
+    if field == 'id':
+        return Q(**{'id__%s' % op: sku_id})
+    return Q(**{'%s__%s' % (field, op): value}) | Q(**{field: value, 'id__%s' % op: sku_id})
+
+
+def get_list_page(type, sort, page, after=None, before=None):
+    """获取列表页某一页的商品
+
+    翻到相邻页时带上当前页的游标(after: 最后一个商品, before: 第一个商品)，
+    按(排序字段, id)定位，深页和第1页代价相同；没有游标时退化为OFFSET分页。
+    商品总数使用缓存，不执行 COUNT(*)。
+    返回 paginator, page_skus
+    """
+    field, asc = LIST_SORTS[sort]
+    order = [field, 'id'] if asc else ['-' + field, '-id']
+    if field == 'id':
+        order = order[1:]
+    skus = GoodsSKU.objects.filter(type=type).order_by(*order)
+
+    # 对数据进行分页
+    paginator = CountedPaginator(skus, settings.GOODS_LIST_PAGE_SIZE, get_type_sku_count(type.id))
+    # 传入的page大于最大值
+    if page < 1 or page > paginator.num_pages:
+        page = 1
+
+    object_list = None
+    if after and page > 1:
+        condition = _keyset_filter(field, asc, after, forward=True)
+        if condition is not None:
+            object_list = list(skus.filter(condition)[:paginator.per_page])
+    elif before and page < paginator.num_pages:
+        condition = _keyset_filter(field, asc, before, forward=False)
+        if condition is not None:
+            # 反向排序取前一页，再恢复原顺序
+            reverse = [o[1:] if o.startswith('-') else '-' + o for o in order]
+            object_list = list(skus.filter(condition).order_by(*reverse)[:paginator.per_page])
+            object_list.reverse()
+
+    if object_list:
+        page_skus = Page(object_list, page, paginator)
+    else:
+        # 获取page页数据
+        page_skus = paginator.page(page)
+
+    # 相邻页的游标
+    if len(page_skus):
+        page_skus.next_cursor = _encode_cursor(page_skus[-1], field)
+        page_skus.previous_cursor = _encode_cursor(page_skus[0], field)
+    return paginator, page_skus
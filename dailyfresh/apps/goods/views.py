@@ -1,12 +1,11 @@
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse
 from django.views.generic import View
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU
-from order.models import OrderGoods
-from django_redis import get_redis_connection
+from django.http import JsonResponse
+from goods.utils import get_index_page_data, get_goods_types, get_detail_data, get_list_page, get_comments
+from goods.rank import get_rank_page, get_new_skus
 from django.conf import settings
-from django.core.cache import cache
-from django.core.paginator import Paginator
+from utils.cache import get_or_rebuild
 
 # Create your views here.
 
@@ -17,47 +16,14 @@ class IndexView(View):
 
     def get(self, request):
         """get请求返回首页"""
-        # 获取缓存
-        content = cache.get('index_page_data')
-        if content is None:
-
-            # 如果没有缓存数据
-            # 获取商品的种类信息
-            types = GoodsType.objects.all()
-            # 获取首页轮播商品信息
-            goods_banner = IndexGoodsBanner.objects.all().order_by('index')
-            # 获取首页促销活动信息
-            promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
-            # 获取首页分类商品展示信息
-
-            for type in types:
-                # 获取首页type种类的图片展示信息
-                image_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-                # 获取首页type种类的文字展示信息
-                title_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-
-                # python 可以动态的给对象添加属性
-                type.image_banner = image_banner
-                type.title_banner = title_banner
-
-            content = {
-                'types': types,
-                'goods_banner': goods_banner,
-                'promotion_banner': promotion_banner,
-                'nginx_url': settings.FDFS_NGINX_URL,
-            }
-
-            # 设置页面数据库查询缓存
-            cache.set('index_page_data', content, 3600)
-
-        # 获取用户购物车中商品的数量
-        user = request.user
-        cart_count = 0
-        if user.is_authenticated():
-            # 用户已登陆
-            con = get_redis_connection('default')
-            cart_key = 'cart_%s' % user.id
-            cart_count = con.hlen(cart_key)
+        # 获取缓存,缓存陈旧或不存在时只由一个请求重建,其他请求继续使用陈旧数据
+        content = get_or_rebuild('index_page_data', get_index_page_data,
+                                 soft_ttl=settings.INDEX_CACHE_SOFT_TTL,
+                                 hard_ttl=settings.INDEX_CACHE_HARD_TTL,
+                                 refresh_ahead=settings.INDEX_CACHE_REFRESH_AHEAD)
+
+        # 获取用户购物车中商品的数量,未登陆为0
+        cart_count = request.user_state.cart_count
 
         # 更新，不存在就添加
         content.update(cart_count=cart_count)
@@ -70,51 +36,26 @@ class DetailView(View):
     """返回商品详情"""
     def get(self, request, goods_id):
         """返回商品信息"""
-        try:
-            sku = GoodsSKU.objects.get(id=goods_id)
-        except GoodsSKU.DoesNotExist:
+        # 获取与用户无关的商品数据,按商品缓存,商品信息修改时缓存版本号更新
+        data = get_detail_data(goods_id)
+        if data is None:
             # 商品不存在
             return redirect(reverse('goods:index'))
         # 获取商品的全部种类信息
-        types = GoodsType.objects.all()
-
-        # 获取评论信息,排除没有评论订单
-        sku_order = OrderGoods.objects.filter(sku=sku).exclude(comment='')
+        types = get_goods_types()
 
-        # 获取新品推荐,从sku中获取对应类型的商品，并按照时间降序,取前两个
-        new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:2]
-
-        # 获取同一个SPU其他规格的商品信息
-        same_spu_sku = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=goods_id)
-        # 获取用户购物车中商品的数量
-        user = request.user
-        cart_count = 0
-        if user.is_authenticated():
-            # 用户已登陆
-            con = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = con.hlen(cart_key)
-
-            # 添加用户浏览记录
-            con = get_redis_connection('default')
-            history_key = 'history_%d' % user.id
-            # 移除当前商品的商品的浏览记录
-            con.lrem(history_key, 0, goods_id)
-            # 添加商品到浏览记录
-            con.lpush(history_key, goods_id)
-            # 只保留最新的5条浏览记录
-            con.ltrim(history_key, 0, 5)
+        # 添加用户浏览记录,与读取购物车数量在同一个pipeline中发送
+        request.user_state.add_history(goods_id)
+        # 获取用户购物车中商品的数量,未登陆为0
+        cart_count = request.user_state.cart_count
 
         # 组织上下文
         context = {
-            'sku': sku,
             'types': types,
-            'sku_order': sku_order,
-            'new_skus': new_skus,
             'cart_count': cart_count,
-            'same_spu_sku': same_spu_sku,
             'nginx_url': settings.FDFS_NGINX_URL,
         }
+        context.update(data)
 
         return render(request, 'detail.html', context)
 
@@ -124,31 +65,22 @@ class ListView(View):
     """列表页"""
     def get(self, request, type_id, page):
         """列表页"""
-        # 获取种类信息
-        try:
-            type = GoodsType.objects.get(id=type_id)
-        except GoodsType.DoesNotExist:
-            return redirect(reverse('goods:index'))
-
         # 获取商品的分类信息
-        types = GoodsType.objects.all()
+        types = get_goods_types()
+
+        # 获取种类信息,从缓存的种类中查找
+        type_id = int(type_id)
+        type = next((t for t in types if t.id == type_id), None)
+        if type is None:
+            return redirect(reverse('goods:index'))
         # 获取排序方式
         # sort = default, 默认方式按id排
         # sort = price, 按价格排
         # sort = hot, 按销量sales排
         sort = request.GET.get('sort')
 
-        # 获取分类商品信息
-        if sort == 'price':
-            skus = GoodsSKU.objects.filter(type=type).order_by('price')
-        elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(type=type).order_by('-sales')
-        else:
+        if sort not in ('price', 'hot'):
             sort = 'default'
-            skus = GoodsSKU.objects.filter(type=type).order_by('-id')
-
-        # 对数据进行分页
-        paginator = Paginator(skus, 1)
 
         # 判断传过来的page数据
         try:
@@ -156,11 +88,17 @@ class ListView(View):
         except Exception as e:
             page = 1
 
-        # 传入的page大于最大值
-        if page > paginator.num_pages:
-            page = 1
-        # 获取page页数据
-        page_skus = paginator.page(page)
+        # 获取分类商品的分页数据,翻到相邻页时使用游标定位
+        after = request.GET.get('after')
+        before = request.GET.get('before')
+        result = None
+        if settings.GOODS_RANK_ENABLED:
+            # 从redis排序集合分页,排序集合还未建立时返回None
+            result = get_rank_page(type, sort, page)
+        if result is None:
+            result = get_list_page(type, sort, page, after, before)
+        paginator, page_skus = result
+        page = page_skus.number
 
         # 进行页码控制，最多只显示5页
         # 1.总页数小于5，显示所有页码
@@ -178,15 +116,9 @@ class ListView(View):
             pages = range(page - 2, page + 3)
 
         # 获取新品推荐,从sku中获取对应类型的商品，并按照时间降序,取前两个
-        new_skus = GoodsSKU.objects.filter(type=type).order_by('-create_time')[:2]
-        # 获取用户购物车中商品的数量
-        user = request.user
-        cart_count = 0
-        if user.is_authenticated():
-            # 用户已登陆
-            con = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = con.hlen(cart_key)
+        new_skus = get_new_skus(type.id)
+        # 获取用户购物车中商品的数量,未登陆为0
+        cart_count = request.user_state.cart_count
 
         context = {
             'type': type,
@@ -201,3 +133,25 @@ class ListView(View):
 
         return render(request, 'list.html', context)
 
+
+
+# goods/商品id/comments?page=页码
+class CommentListView(View):
+    """商品评论分页,详情页通过ajax加载更多评论"""
+    def get(self, request, goods_id):
+        """返回第page页的评论"""
+        try:
+            page = int(request.GET.get('page', 1))
+        except Exception as e:
+            page = 1
+        if page < 1:
+            page = 1
+
+        comments, has_next = get_comments(goods_id, page)
+        comments = [{
+            'username': order_sku.order.user.username,
+            'comment': order_sku.comment,
+            'time': order_sku.up_time.strftime('%Y-%m-%d %H:%M:%S'),
+        } for order_sku in comments]
+
+        return JsonResponse({'res': 1, 'comments': comments, 'has_next': has_next, 'page': page})
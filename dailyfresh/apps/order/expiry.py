@@ -0,0 +1,134 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from goods.models import GoodsSKU
+from goods.utils import delete_sku_cache
+from goods.rank import incr_sales_rank
+from cart.utils import incr_sku_stock
+from order.models import OrderInfo, OrderGoods
+from order.utils import _count_case, order_deadline, schedule_expiry, delete_order_summary, ORDER_DEADLINES_KEY
+from order.reservation import order_reserve_key, release_reservation, confirm_reservations
+from utils.user_store import get_user_store
+
+logger = logging.getLogger(__name__)
+
+# 未支付订单超时取消: 下单时在线支付的订单id加入截止时间集合(分值为支付截止时间)，支付后移除;
+# 货到付款的订单一直是待支付状态，不会被取消
+# 定时任务按截止时间顺序每次取出一批到期的订单，一个事务中批量取消并恢复库存，
+# 每批的代价与未支付订单的总数无关
+
+
+def cancel_unpaid_orders(order_ids):
+    """批量取消未支付的订单并恢复库存和销量，返回取消的订单id列表; 已支付及货到付款的订单不取消
+
+    一个事务中: 锁定仍未支付的订单，一条 UPDATE 改为已取消，一条 UPDATE 按商品恢复库存和销量;
+    使用预留库存的商品没有扣减数据库库存，事务提交后释放预留记录，由结算任务恢复
+    """
+    with transaction.atomic():
+        orders = dict(OrderInfo.objects.select_for_update()
+                      .filter(order_id__in=order_ids, order_status=1)
+                      .exclude(pay_method=1)
+                      .values_list('order_id', 'user_id'))
+        order_ids = list(orders)
+        if not order_ids:
+            return []
+        OrderInfo.objects.filter(order_id__in=order_ids).update(order_status=6)
+
+        # 各订单使用预留库存的商品
+        pipe = get_user_store().pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.hkeys(order_reserve_key(order_id))
+        reserved = {order_id: set(int(sku_id) for sku_id in sku_ids)
+                    for order_id, sku_ids in zip(order_ids, pipe.execute()) if sku_ids}
+
+        counts = {}
+        for order_id, sku_id, count in OrderGoods.objects.filter(order_id__in=order_ids) \
+                .values_list('order_id', 'sku_id', 'count'):
+            if sku_id not in reserved.get(order_id, ()):
+                counts[sku_id] = counts.get(sku_id, 0) + count
+        if counts:
+            GoodsSKU.objects.filter(id__in=counts.keys()).update(stock=F('stock') + _count_case(counts),
+                                                                 sales=F('sales') - _count_case(counts))
+
+    for order_id in reserved:
+        release_reservation(order_id)
+    delete_order_summary(*set(orders.values()))
+    if counts:
+        # update 不触发信号，同步商品库存镜像、缓存及销量排序
+        incr_sku_stock(counts)
+        delete_sku_cache(*counts.keys())
+        skus = GoodsSKU.objects.filter(id__in=counts.keys()).only('id', 'type')
+        incr_sales_rank([(sku.type_id, sku.id, -counts[sku.id]) for sku in skus])
+    return order_ids
+
+
+def expire_unpaid_orders(batch_size=None):
+    """取消超过支付截止时间仍未支付的订单，返回取消的订单数
+
+    处理失败的批次推迟 ORDER_EXPIRE_INTERVAL 秒后重试，不阻塞之后到期的订单
+    """
+    batch_size = batch_size or settings.ORDER_EXPIRE_BATCH_SIZE
+    con = get_user_store()
+    now = int(time.time())
+    cancelled = 0
+    while True:
+        order_ids = [order_id.decode() for order_id in
+                     con.zrangebyscore(ORDER_DEADLINES_KEY, 0, now, start=0, num=batch_size)]
+        if not order_ids:
+            break
+        try:
+            cancelled += _expire_batch(order_ids)
+        except Exception:
+            logger.exception('expire unpaid orders failed, retry later: %s', order_ids)
+            schedule_expiry({order_id: now + settings.ORDER_EXPIRE_INTERVAL for order_id in order_ids}, client=con)
+            continue
+        # 处理过的订单都从截止时间集合中删除
+        con.zrem(ORDER_DEADLINES_KEY, *order_ids)
+    return cancelled
+
+
+def _expire_batch(order_ids):
+    """处理一批到期的订单，返回取消的订单数; 可以重复执行"""
+    cancelled_ids = cancel_unpaid_orders(order_ids)
+    others = set(order_ids) - set(cancelled_ids)
+    if others:
+        statuses = dict(OrderInfo.objects.filter(order_id__in=others).values_list('order_id', 'order_status'))
+        for order_id in others:
+            if statuses.get(order_id, 6) == 6:
+                # 写入订单失败，或上次取消后没来得及释放预留库存; 释放可以重复调用
+                release_reservation(order_id)
+        # 已支付或货到付款，预留的库存不再释放
+        confirm_reservations([order_id for order_id, status in statuses.items() if status != 6])
+    return len(cancelled_ids)
+
+
+def load_unpaid_orders(batch_size=1000):
+    """将数据库中在线支付的未支付订单加入截止时间集合(启用超时取消前创建的订单)，返回加入的订单数
+
+    按订单id分批读取，已在集合中的订单只更新截止时间
+    """
+    con = get_user_store()
+    pending = OrderInfo.objects.filter(order_status=1).exclude(pay_method=1).order_by('order_id') \
+        .only('order_id', 'create_time')
+    last_order_id = ''
+    loaded = 0
+    while True:
+        orders = list(pending.filter(order_id__gt=last_order_id)[:batch_size])
+        if not orders:
+            break
+        last_order_id = orders[-1].order_id
+        schedule_expiry({order.order_id: order_deadline(order.create_time) for order in orders}, client=con)
+        loaded += len(orders)
+    return loaded
+
+
+def pending_expiry_stats():
+    """截止时间集合中的订单数及已到期的订单数"""
+    pipe = get_user_store().pipeline(transaction=False)
+    pipe.zcard(ORDER_DEADLINES_KEY)
+    pipe.zcount(ORDER_DEADLINES_KEY, 0, int(time.time()))
+    total, due = pipe.execute()
+    return total, due
@@ -0,0 +1,79 @@
+import os
+import time
+
+from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
+from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
+from alipay.aop.api.domain.AlipayTradeQueryModel import AlipayTradeQueryModel
+from alipay.aop.api.request.AlipayTradeQueryRequest import AlipayTradeQueryRequest
+from alipay.aop.api.util.SignatureUtils import get_sign_content, sign_with_rsa2, verify_with_rsa
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from utils.pay.alipay import AlipayClient, get_alipay_client
+
+
+def sdk_client():
+    """改为共用客户端之前的做法: 每次请求读取密钥文件并创建SDK客户端"""
+    config = AlipayClientConfig()
+    config.server_url = settings.ALIPAY_GATEWAY
+    config.app_id = settings.ALIPAY_APP_ID
+    with open(settings.MY_PRIVATE_KEY, 'r') as f:
+        config.app_private_key = f.read()
+    with open(settings.ALIPAY_PUBLIC_KEY, 'r') as f:
+        config.alipay_public_key = f.read()
+    return DefaultAlipayClient(alipay_client_config=config)
+
+
+def query_request(i):
+    model = AlipayTradeQueryModel()
+    model.out_trade_no = '20190806163037%08d' % i
+    return AlipayTradeQueryRequest(biz_model=model)
+
+
+class Command(BaseCommand):
+    """支付宝客户端签名及构造请求的吞吐量: python manage.py alipay_benchmark --number 200
+
+    before: 每次创建SDK客户端，签名时重新解析私钥; after: 进程内共用的客户端
+    验签使用应用公钥验证应用私钥的签名，不需要支付宝的私钥; 不发送网络请求
+    """
+    help = '对比每次创建SDK客户端与共用客户端的签名、验签、构造请求的吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200, help='每项测试的次数')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        with open(settings.MY_PRIVATE_KEY, 'r') as f:
+            private_key = f.read()
+        with open(os.path.join(settings.BASE_DIR, 'utils/pay/app_public_key.pem'), 'r') as f:
+            public_key = f.read()
+        client = get_alipay_client()
+        # 验签用的客户端，以应用公钥代替支付宝公钥
+        verify_client = AlipayClient(settings.ALIPAY_GATEWAY, settings.ALIPAY_APP_ID, private_key, public_key)
+
+        content = get_sign_content({'app_id': settings.ALIPAY_APP_ID, 'method': 'alipay.trade.query',
+                                    'biz_content': '{"out_trade_no":"2019080616303700000001"}'})
+        sign = client.sign(content)
+        if sign != sign_with_rsa2(private_key, content, 'utf-8'):
+            raise CommandError('signature differs from the sdk')
+        if not verify_client.verify(content.encode('utf-8'), sign):
+            raise CommandError('signature verify failed')
+
+        cases = [
+            ('sign', lambda i: sign_with_rsa2(private_key, content, 'utf-8'), lambda i: client.sign(content)),
+            ('verify', lambda i: verify_with_rsa(public_key, content.encode('utf-8'), sign),
+             lambda i: verify_client.verify(content.encode('utf-8'), sign)),
+            ('page request', lambda i: sdk_client().page_execute(query_request(i), http_method='GET'),
+             lambda i: client.page_execute(query_request(i))),
+        ]
+        self.stdout.write('%-14s %12s %12s %9s' % ('', 'before(op/s)', 'after(op/s)', 'speedup'))
+        for name, before, after in cases:
+            before_rate = self.measure(before, number)
+            after_rate = self.measure(after, number)
+            self.stdout.write('%-14s %12.1f %12.1f %8.1fx' % (name, before_rate, after_rate, after_rate / before_rate))
+
+    def measure(self, func, number):
+        """每秒执行次数"""
+        start = time.time()
+        for i in range(number):
+            func(i)
+        return number / (time.time() - start)
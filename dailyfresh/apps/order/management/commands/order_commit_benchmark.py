@@ -0,0 +1,120 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from goods.models import GoodsSKU
+from goods.rank import update_sku_rank
+from goods.utils import delete_sku_cache
+from cart.utils import delete_sku_stock
+from user.models import User, Address
+from order.models import OrderInfo
+from order.utils import ORDER_COMMIT_MODES, OrderError
+
+# 压测使用的用户名前缀，结束后删除
+BENCHMARK_USER_PREFIX = 'order_benchmark_'
+
+
+class Command(BaseCommand):
+    """对比悲观锁与乐观锁下单: python manage.py order_commit_benchmark --buyers 20 --orders 20
+
+    只能在本地数据库运行: 会临时修改商品库存，结束后恢复库存、销量并删除压测的用户和订单
+    hot: 所有买家抢同一个商品; cold: 每个买家购买不同的商品
+    """
+    help = '并发下单压测，输出悲观锁、乐观锁在热点/非热点商品上的吞吐量、p99延迟及失败率'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=20, help='并发买家数(线程数)')
+        parser.add_argument('--orders', type=int, default=20, help='每个买家下单次数')
+        parser.add_argument('--count', type=int, default=1, help='每单购买的数量')
+        parser.add_argument('--stock', type=int, default=0, help='压测前商品的库存，默认足够所有订单')
+        parser.add_argument('--modes', nargs='*', default=sorted(ORDER_COMMIT_MODES), choices=sorted(ORDER_COMMIT_MODES))
+        parser.add_argument('--scenarios', nargs='*', default=['hot', 'cold'], choices=['hot', 'cold'])
+
+    def handle(self, *args, **options):
+        buyers = options['buyers']
+        sku_ids = list(GoodsSKU.objects.order_by('id').values_list('id', flat=True)[:buyers])
+        if not sku_ids:
+            raise CommandError('no goods sku in database')
+        stock = options['stock'] or buyers * options['orders'] * options['count']
+        # 记录原来的库存和销量，压测后恢复
+        origin = {sku.id: (sku.stock, sku.sales) for sku in GoodsSKU.objects.filter(id__in=sku_ids)}
+
+        users = self.create_buyers(buyers)
+        try:
+            self.stdout.write('%-12s %-6s %8s %10s %10s %8s' % ('mode', 'sku', 'orders', 'orders/s', 'p99(ms)', 'abort'))
+            for scenario in options['scenarios']:
+                for mode in options['modes']:
+                    GoodsSKU.objects.filter(id__in=sku_ids).update(stock=stock)
+                    if scenario == 'hot':
+                        buyer_skus = [sku_ids[0]] * buyers
+                    else:
+                        buyer_skus = [sku_ids[i % len(sku_ids)] for i in range(buyers)]
+                    self.report(mode, scenario, self.run(ORDER_COMMIT_MODES[mode], users, buyer_skus, options))
+        finally:
+            self.cleanup(users, origin)
+
+    def create_buyers(self, buyers):
+        """创建压测用户及收货地址"""
+        users = []
+        for i in range(buyers):
+            user, created = User.objects.get_or_create(username=BENCHMARK_USER_PREFIX + str(i))
+            addr = Address.objects.create(user=user, receiver='benchmark', addr='benchmark', phone='10000000000')
+            users.append((user, addr))
+        return users
+
+    def run(self, create_order, users, buyer_skus, options):
+        """每个买家一个线程连续下单，返回 成功数, 失败数, 各单延迟, 总耗时"""
+        latencies = []
+        aborts = []
+        lock = threading.Lock()
+
+        def buyer(user, addr, sku_id):
+            local_latencies = []
+            local_aborts = 0
+            try:
+                for i in range(options['orders']):
+                    start = time.time()
+                    try:
+                        create_order(user, addr, 3, [sku_id], {sku_id: options['count']})
+                    except OrderError:
+                        local_aborts += 1
+                    local_latencies.append(time.time() - start)
+            finally:
+                # 每个线程使用自己的数据库连接，结束时关闭
+                connection.close()
+            with lock:
+                latencies.extend(local_latencies)
+                aborts.append(local_aborts)
+
+        threads = [threading.Thread(target=buyer, args=(user, addr, sku_id))
+                   for (user, addr), sku_id in zip(users, buyer_skus)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        aborted = sum(aborts)
+        return len(latencies) - aborted, aborted, latencies, elapsed
+
+    def report(self, mode, scenario, result):
+        succeeded, aborted, latencies, elapsed = result
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+        total = succeeded + aborted
+        self.stdout.write('%-12s %-6s %8d %10.1f %10.1f %7.1f%%' % (
+            mode, scenario, total, succeeded / elapsed if elapsed else 0, p99 * 1000,
+            100.0 * aborted / total if total else 0))
+
+    def cleanup(self, users, origin):
+        """删除压测用户及其订单，恢复商品的库存、销量及redis中的排序、镜像"""
+        user_ids = [user.id for user, addr in users]
+        OrderInfo.objects.filter(user_id__in=user_ids).delete()
+        User.objects.filter(id__in=user_ids).delete()
+        for sku_id, (stock, sales) in origin.items():
+            GoodsSKU.objects.filter(id=sku_id).update(stock=stock, sales=sales)
+        for sku in GoodsSKU.objects.filter(id__in=origin.keys()):
+            update_sku_rank(sku)
+        delete_sku_stock(*origin.keys())
+        delete_sku_cache(*origin.keys())
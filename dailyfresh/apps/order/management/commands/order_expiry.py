@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from order.expiry import expire_unpaid_orders, load_unpaid_orders, pending_expiry_stats
+
+
+class Command(BaseCommand):
+    """未支付订单的超时取消
+
+    python manage.py order_expiry load     将数据库中在线支付的未支付订单加入截止时间集合(首次启用时执行)
+    python manage.py order_expiry expire   立即取消已到期的订单
+    python manage.py order_expiry stats    集合中的订单数及已到期的订单数
+    """
+    help = '加载未支付订单的支付截止时间，取消超时未支付的订单'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['load', 'expire', 'stats'])
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'load':
+            loaded = load_unpaid_orders(options['batch_size'] or 1000)
+            self.stdout.write('loaded %d unpaid orders' % loaded)
+        elif action == 'expire':
+            cancelled = expire_unpaid_orders(options['batch_size'])
+            self.stdout.write('cancelled %d unpaid orders' % cancelled)
+        else:
+            total, due = pending_expiry_stats()
+            self.stdout.write('pending: %d, due: %d' % (total, due))
@@ -0,0 +1,84 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from user.models import User, Address
+from order.models import OrderInfo
+from order.reconcile import reconcile_payments
+from utils.pay.fake_alipay import FakeAlipayGateway
+
+# 模拟对账使用的用户名，结束后删除
+FAKE_USER = 'reconcile_benchmark'
+
+
+class Command(BaseCommand):
+    """对账未支付的支付宝订单: python manage.py reconcile_payments
+
+    --fake N: 离线压测，创建N个未支付订单，在本地模拟的支付宝中随机设置为已支付、等待支付、已关闭或不存在，
+    对账后检查订单状态并输出吞吐量，结束后删除压测的用户和订单
+    """
+    help = '主动查询未支付的支付宝订单并处理已支付的订单，--fake 使用本地模拟的支付宝压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='并发查询的线程数')
+        parser.add_argument('--rate', type=float, default=None, help='每秒最多查询次数，0为不限制')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--fake', type=int, default=0, metavar='N', help='使用模拟的支付宝对账N个新建的订单')
+        parser.add_argument('--latency', type=float, default=0.05, help='模拟的支付宝每次查询的耗时(秒)')
+        parser.add_argument('--gateway-limit', type=int, default=None, help='模拟的支付宝每秒允许的调用次数')
+
+    def handle(self, *args, **options):
+        kwargs = {'workers': options['workers'], 'rate': options['rate'], 'batch_size': options['batch_size']}
+        if not options['fake']:
+            self.report(reconcile_payments(**kwargs), None)
+            return
+
+        gateway = FakeAlipayGateway(options['latency'], options['gateway_limit'])
+        user, order_ids = self.create_orders(options['fake'])
+        try:
+            expected = {}
+            for order_id in order_ids:
+                state = random.choice(('paid', 'wait', 'close', 'none'))
+                if state == 'paid':
+                    expected[order_id] = gateway.pay(order_id)
+                elif state == 'wait':
+                    gateway.wait(order_id)
+                elif state == 'close':
+                    gateway.close(order_id)
+
+            start = time.time()
+            stats = reconcile_payments(gateway.query, min_age=0, limit=len(order_ids) * 2, **kwargs)
+            elapsed = time.time() - start
+            self.report(stats, elapsed)
+            self.stdout.write('gateway calls: %d, throttled: %d, max concurrency: %d' % (
+                gateway.calls, gateway.throttled, gateway.max_concurrency))
+            self.check(user, expected, stats)
+        finally:
+            OrderInfo.objects.filter(user=user).delete()
+            user.delete()
+
+    def create_orders(self, count):
+        """创建压测用户及未支付订单"""
+        user, created = User.objects.get_or_create(username=FAKE_USER)
+        addr = Address.objects.create(user=user, receiver='benchmark', addr='benchmark', phone='10000000000')
+        prefix = time.strftime('%Y%m%d%H%M%S')
+        orders = [OrderInfo(order_id='%s%08d%s' % (prefix, i, user.id), user=user, addr=addr, pay_method=3,
+                            total_count=1, total_price=10, transit_price=10) for i in range(count)]
+        OrderInfo.objects.bulk_create(orders, batch_size=1000)
+        return user, [order.order_id for order in orders]
+
+    def report(self, stats, elapsed):
+        self.stdout.write('checked: %(checked)d, paid: %(paid)d, waiting: %(waiting)d, closed: %(closed)d, '
+                          'failed: %(failed)d' % stats)
+        if elapsed:
+            self.stdout.write('%.1fs, %.1f orders/s' % (elapsed, stats['checked'] / elapsed))
+
+    def check(self, user, expected, stats):
+        """已支付的订单都改为待评价并保存了交易号，其他订单仍未支付; 被限流的订单允许下次处理"""
+        paid = dict(OrderInfo.objects.filter(user=user, order_status=4).values_list('order_id', 'trade_no'))
+        wrong = [order_id for order_id, trade_no in paid.items() if expected.get(order_id) != trade_no]
+        missed = len([order_id for order_id in expected if order_id not in paid])
+        if wrong or missed > stats['failed']:
+            self.stderr.write('FAILED: %d orders paid wrongly, %d paid orders missed' % (len(wrong), missed))
+        else:
+            self.stdout.write('OK: %d of %d paid orders updated' % (len(paid), len(expected)))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from order.reservation import load_reserve_stock, unload_reserve_stock, settle_reserved_stock, \
+    check_reserve_stock, reserve_key
+from utils.user_store import get_user_store
+
+
+class Command(BaseCommand):
+    """热点商品预留库存的管理及对账
+
+    python manage.py reserve_stock load 商品id ...     开始使用预留库存下单
+    python manage.py reserve_stock unload 商品id ...   停止使用预留库存下单
+    python manage.py reserve_stock settle              立即结算
+    python manage.py reserve_stock check [--fix]       对账: redis中的可用库存 = 数据库库存 - 未结算数量
+    """
+    help = '加载、停止、结算热点商品的预留库存，核对redis与数据库的库存是否一致'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['load', 'unload', 'settle', 'check'])
+        parser.add_argument('sku_ids', nargs='*', type=int)
+        parser.add_argument('--force', action='store_true', help='load 时覆盖已加载的可用库存')
+        parser.add_argument('--fix', action='store_true', help='check 时将不一致的可用库存改为数据库的值')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+        if action in ('load', 'unload') and not sku_ids:
+            raise CommandError('sku ids are required')
+
+        if action == 'load':
+            loaded = load_reserve_stock(sku_ids, force=options['force'])
+            self.stdout.write('loaded reserve stock of skus: %s' % loaded)
+        elif action == 'unload':
+            unload_reserve_stock(sku_ids)
+            self.stdout.write('unloaded reserve stock of skus: %s' % sku_ids)
+        elif action == 'settle':
+            self.stdout.write('settled %d skus' % settle_reserved_stock())
+        else:
+            mismatched = 0
+            for sku_id, reserved, expected in check_reserve_stock(sku_ids or None):
+                if reserved == expected:
+                    continue
+                mismatched += 1
+                self.stdout.write('sku %s: redis %d, database %d' % (sku_id, reserved, expected))
+                if options['fix']:
+                    get_user_store().set(reserve_key(sku_id), max(expected, 0))
+            self.stdout.write('%d skus mismatched' % mismatched)
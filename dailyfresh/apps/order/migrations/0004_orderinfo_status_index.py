@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0003_auto_order_status_cancelled'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='orderinfo',
+            index_together=set([('order_status', 'order_id')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0005_orderinfo_user_create_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSettlement',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('create_time', models.DateTimeField(verbose_name='创建时间', auto_now_add=True)),
+                ('up_time', models.DateTimeField(verbose_name='修改时间', auto_now=True)),
+                ('id_delete', models.BooleanField(verbose_name='删除标记', default=False)),
+                ('batch_id', models.CharField(verbose_name='结算批次id', unique=True, max_length=32)),
+            ],
+            options={
+                'verbose_name': '库存结算批次',
+                'verbose_name_plural': '库存结算批次',
+                'db_table': 'df_stock_settlement',
+            },
+        ),
+    ]
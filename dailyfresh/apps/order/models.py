@@ -23,7 +23,8 @@ class OrderInfo(BaseModel):
         2: '待发货',
         3: '待收货',
         4: '待评价',
-        5: '已完成'
+        5: '已完成',
+        6: '已取消'
     }
 
     ORDER_STATUS_CHOICES = (
@@ -31,7 +32,8 @@ class OrderInfo(BaseModel):
         (2, '待发货'),
         (3, '待收货'),
         (4, '待评价'),
-        (5, '已完成')
+        (5, '已完成'),
+        (6, '已取消')
     )
 
     order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单id')
@@ -46,6 +48,8 @@ class OrderInfo(BaseModel):
 
     class Meta:
         db_table = 'df_order_info'
+        # 按状态分批扫描订单(如对账任务查询未支付订单); 用户中心按时间分页显示用户的订单
+        index_together = [('order_status', 'order_id'), ('user', 'create_time')]
         verbose_name = '订单'
         verbose_name_plural = verbose_name
 
@@ -61,4 +65,14 @@ class OrderGoods(BaseModel):
     class Meta:
         db_table = 'df_order_goods'
         verbose_name = '订单商品'
-        verbose_name_plural = verbose_name
\ No newline at end of file
+        verbose_name_plural = verbose_name
+
+
+class StockSettlement(BaseModel):
+    '''预留库存结算批次模型类，与库存修改在同一个事务中写入，避免重复结算'''
+    batch_id = models.CharField(max_length=32, unique=True, verbose_name='结算批次id')
+
+    class Meta:
+        db_table = 'df_stock_settlement'
+        verbose_name = '库存结算批次'
+        verbose_name_plural = verbose_name
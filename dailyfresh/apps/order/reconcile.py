@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from order.models import OrderInfo
+from order.utils import orders_paid
+from utils.pay.alipay import alipay_trade_query
+
+logger = logging.getLogger(__name__)
+
+# 支付成功的交易状态
+PAID_TRADE_STATUS = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+
+# 上次对账查询到的订单id，下次从之后的订单继续，未支付订单超过 limit 个时每次查询不同的订单
+RECONCILE_CURSOR_KEY = 'alipay_reconcile_cursor'
+
+
+class RateLimiter(object):
+    """限制每秒的调用次数，多个线程共用: 依次给每次调用分配间隔相等的时间点"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def _query_payment(query, limiter, order):
+    """查询一个订单的支付结果，请求失败时返回None"""
+    limiter.wait()
+    try:
+        return query(order)
+    except Exception:
+        logger.exception('query alipay trade %s failed', order.order_id)
+        return None
+
+
+def reconcile_payments(query=alipay_trade_query, batch_size=None, workers=None, rate=None, min_age=None,
+                       limit=None):
+    """主动查询未支付的支付宝订单，批量处理已经支付的订单
+
+    未支付订单按订单id分批读取，每批在最多 workers 个线程中并发查询，总速率不超过每秒 rate 次;
+    只查询创建 min_age 秒以上的订单，刚下单的由异步通知和支付页处理; 一次最多查询 limit 个订单，
+    从上次对账结束的订单id继续，到最后一个订单后从头开始。
+    返回统计 {'checked': 查询数, 'paid': 改为已支付的订单数, 'waiting': 未支付, 'closed': 交易已关闭, 'failed': 查询失败}
+    """
+    batch_size = batch_size or settings.ALIPAY_RECONCILE_BATCH_SIZE
+    workers = workers or settings.ALIPAY_RECONCILE_WORKERS
+    rate = settings.ALIPAY_RECONCILE_RATE if rate is None else rate
+    min_age = settings.ALIPAY_RECONCILE_MIN_AGE if min_age is None else min_age
+    limit = limit or settings.ALIPAY_RECONCILE_LIMIT
+
+    stats = dict.fromkeys(('checked', 'paid', 'waiting', 'closed', 'failed'), 0)
+    pending = OrderInfo.objects.filter(order_status=1, pay_method=3,
+                                       create_time__lte=timezone.now() - timedelta(seconds=min_age))
+    limiter = RateLimiter(rate)
+    start_order_id = cache.get(RECONCILE_CURSOR_KEY) or ''
+    last_order_id = start_order_id
+    wrapped = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while stats['checked'] < limit:
+            batch = pending.filter(order_id__gt=last_order_id)
+            if wrapped:
+                # 从头开始后只查询到本次开始的位置
+                batch = batch.filter(order_id__lte=start_order_id)
+            orders = list(batch.order_by('order_id').only('order_id')[:min(batch_size, limit - stats['checked'])])
+            if not orders:
+                last_order_id = ''
+                if wrapped or not start_order_id:
+                    break
+                wrapped = True
+                continue
+            last_order_id = orders[-1].order_id
+
+            trade_nos = {}
+            responses = executor.map(lambda order: _query_payment(query, limiter, order), orders)
+            for order, response in zip(orders, responses):
+                stats['checked'] += 1
+                if response is None or response.code not in ('10000', '40004'):
+                    # 请求失败或被限流，下次再查询
+                    stats['failed'] += 1
+                elif response.code == '10000' and response.trade_status in PAID_TRADE_STATUS:
+                    trade_nos[order.order_id] = response.trade_no
+                elif response.code == '10000' and response.trade_status == 'TRADE_CLOSED':
+                    # 交易已关闭，由超时取消处理
+                    stats['closed'] += 1
+                else:
+                    # 交易还未创建或等待买家付款
+                    stats['waiting'] += 1
+            stats['paid'] += len(orders_paid(trade_nos))
+    cache.set(RECONCILE_CURSOR_KEY, last_order_id, None)
+    return stats
@@ -0,0 +1,278 @@
+import uuid
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from goods.models import GoodsSKU
+from goods.utils import delete_sku_cache
+from goods.rank import incr_sales_rank
+from cart.utils import incr_sku_stock
+from order.models import StockSettlement
+from order.utils import OrderError, _check_skus, _count_case, _create_order_rows, _decrease_stock, _new_order_id, _sold, \
+    order_deadline, ORDER_DEADLINES_KEY
+from utils.user_store import get_user_store, user_store_key, user_store_script
+
+# 热点商品预留库存: 促销时将商品的可用库存加载到redis，下单时在redis中原子的扣减，
+# 数据库中的库存和销量由定时任务批量结算，下单不再争抢商品行锁
+# 这些数据保存在用户数据redis中(持久化、不淘汰)
+
+# 扣减预留库存: KEYS 各商品的预留库存, 待结算, 订单预留记录, 订单截止时间集合
+# ARGV 订单id, 支付截止时间, 商品id, 数量, 商品id, 数量...
+# 全部商品库存充足才扣减，返回0; 库存不足返回商品的序号，商品不再预留库存返回负的序号
+RESERVE_LUA = """
+local n = (#ARGV - 2) / 2
+for i = 1, n do
+    local stock = redis.call('get', KEYS[i])
+    if not stock then
+        return -i
+    end
+    if tonumber(stock) < tonumber(ARGV[2 + i * 2]) then
+        return i
+    end
+end
+for i = 1, n do
+    local sku_id = ARGV[1 + i * 2]
+    local count = tonumber(ARGV[2 + i * 2])
+    redis.call('decrby', KEYS[i], count)
+    redis.call('hincrby', KEYS[n + 1], sku_id, count)
+    redis.call('hset', KEYS[n + 2], sku_id, count)
+end
+redis.call('zadd', KEYS[n + 3], ARGV[2], ARGV[1])
+return 0
+"""
+
+# 释放订单预留的库存: KEYS 订单预留记录, 待结算, 订单截止时间集合, 各商品的预留库存; ARGV 订单id, 商品id...
+# 预留记录不存在(已确认或已释放)时不做修改，返回0; 待结算数量减少，结算时数据库的库存和销量恢复
+RELEASE_LUA = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV do
+    local count = tonumber(redis.call('hget', KEYS[1], ARGV[i]))
+    if count then
+        if redis.call('exists', KEYS[i + 2]) == 1 then
+            redis.call('incrby', KEYS[i + 2], count)
+        end
+        redis.call('hincrby', KEYS[2], ARGV[i], -count)
+    end
+end
+redis.call('del', KEYS[1])
+redis.call('zrem', KEYS[3], ARGV[1])
+return 1
+"""
+
+# 开始结算: KEYS 待结算, 结算中, 结算批次id; ARGV 新的批次id
+# 上次结算中断时继续结算上次的数据(沿用上次的批次id)，否则将待结算改名为结算中，之后的下单写入新的待结算
+# 返回 批次id, 商品id, 数量, 商品id, 数量...
+SETTLE_BEGIN_LUA = """
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('exists', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('rename', KEYS[1], KEYS[2])
+end
+redis.call('set', KEYS[3], ARGV[1], 'NX')
+local items = redis.call('hgetall', KEYS[2])
+table.insert(items, 1, redis.call('get', KEYS[3]))
+return items
+"""
+
+# 待结算: {商品id: 已扣减还未写入数据库的数量}，释放的预留为负数
+PENDING_KEY = user_store_key('stock_reserve_pending')
+SETTLING_KEY = user_store_key('stock_reserve_settling')
+# 结算中批次的id，与结算记录在同一个事务中写入数据库，已写入的批次不再重复结算
+SETTLING_BATCH_KEY = user_store_key('stock_reserve_settling_batch')
+# 结算互斥锁，定时任务和手动结算不同时执行
+SETTLE_LOCK_KEY = user_store_key('stock_reserve_settle_lock')
+
+
+def reserve_key(sku_id):
+    """商品预留库存的键，存在表示商品使用预留库存下单"""
+    return user_store_key('stock_reserve_%s' % sku_id)
+
+
+def order_reserve_key(order_id):
+    """订单预留记录的键 {商品id: 数量}，订单支付或取消后删除"""
+    return user_store_key('stock_reserve_order_%s' % order_id)
+
+
+def reserved_sku_ids(sku_ids):
+    """返回sku_ids中使用预留库存的商品id集合"""
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return set()
+    pipe = get_user_store().pipeline(transaction=False)
+    for sku_id in sku_ids:
+        pipe.exists(reserve_key(sku_id))
+    return set(int(sku_id) for sku_id, exists in zip(sku_ids, pipe.execute()) if exists)
+
+
+def _pending_counts(key):
+    """读取待结算或结算中的数量 {商品id: 数量}"""
+    return {int(sku_id): int(count) for sku_id, count in get_user_store().hgetall(key).items()}
+
+
+def load_reserve_stock(sku_ids, force=False):
+    """将商品的可用库存加载到redis，开始使用预留库存下单，返回加载的商品id
+
+    可用库存 = 数据库库存 - 还未结算的数量; force 为False时已经加载的商品不覆盖
+    """
+    pending = _pending_counts(PENDING_KEY)
+    settling = _pending_counts(SETTLING_KEY)
+    con = get_user_store()
+    loaded = []
+    for sku in GoodsSKU.objects.filter(id__in=sku_ids).only('id', 'stock'):
+        stock = sku.stock - pending.get(sku.id, 0) - settling.get(sku.id, 0)
+        if con.set(reserve_key(sku.id), max(stock, 0), nx=not force):
+            loaded.append(sku.id)
+    return loaded
+
+
+def unload_reserve_stock(sku_ids):
+    """商品不再使用预留库存下单，已扣减的数量仍由结算任务写入数据库"""
+    get_user_store().delete(*[reserve_key(sku_id) for sku_id in sku_ids])
+
+
+def reserve(order_id, sku_counts):
+    """扣减订单中预留库存商品的库存，sku_counts: {商品id: 数量}; 返回结果，库存不足或不再预留时抛出 OrderError"""
+    sku_ids = sorted(sku_counts)
+    keys = [reserve_key(sku_id) for sku_id in sku_ids] + [PENDING_KEY, order_reserve_key(order_id),
+                                                          ORDER_DEADLINES_KEY]
+    args = [order_id, order_deadline()]
+    for sku_id in sku_ids:
+        args.extend([sku_id, sku_counts[sku_id]])
+    res = user_store_script(RESERVE_LUA)(keys=keys, args=args)
+    if res > 0:
+        raise OrderError(6, '商品库库存不足')
+    if res < 0:
+        # 下单期间商品停止了预留库存，让用户重新提交
+        raise OrderError(7, '下单失败')
+    return res
+
+
+def release_reservation(order_id):
+    """释放订单预留的库存，返回是否释放; 重复调用或订单已确认时不做修改"""
+    con = get_user_store()
+    sku_ids = [int(sku_id) for sku_id in con.hkeys(order_reserve_key(order_id))]
+    if not sku_ids:
+        return False
+    keys = [order_reserve_key(order_id), PENDING_KEY, ORDER_DEADLINES_KEY] + [reserve_key(sku_id) for sku_id in sku_ids]
+    return bool(user_store_script(RELEASE_LUA)(keys=keys, args=[order_id] + sku_ids))
+
+
+def confirm_reservation(order_id):
+    """订单支付成功，预留的库存不再释放"""
+    confirm_reservations([order_id])
+
+
+def confirm_reservations(order_ids):
+    """批量确认已支付订单预留的库存"""
+    if not order_ids:
+        return
+    pipe = get_user_store().pipeline()
+    pipe.delete(*[order_reserve_key(order_id) for order_id in order_ids])
+    pipe.zrem(ORDER_DEADLINES_KEY, *order_ids)
+    pipe.execute()
+
+
+def create_order_reserved(user, addr, pay_method, sku_ids, counts, transit_price=10):
+    """创建订单--预留库存
+
+    热点商品在redis中扣减预留库存，不修改数据库中的商品行，由结算任务批量写入;
+    订单中其他商品使用带条件的 UPDATE 扣减库存; 写入订单失败时释放已扣减的预留库存
+    """
+    sku_ids = sorted(set(int(sku_id) for sku_id in sku_ids))
+    # 不加锁读取商品，数据库中热点商品的库存还未结算，这里只做初步校验
+    skus = list(GoodsSKU.objects.filter(id__in=sku_ids).order_by('id'))
+    sku_counts, total_count, total_price = _check_skus(skus, sku_ids, counts)
+    hot = reserved_sku_ids(sku_ids)
+    order_id = _new_order_id(user)
+
+    reserve(order_id, {sku_id: sku_counts[sku_id] for sku_id in hot})
+    cold_counts = {sku_id: count for sku_id, count in sku_counts.items() if sku_id not in hot}
+    try:
+        with transaction.atomic():
+            order = _create_order_rows(user, addr, pay_method, skus, sku_counts, total_count, total_price,
+                                       transit_price, order_id=order_id)
+            if cold_counts and not _decrease_stock(cold_counts):
+                raise OrderError(6, '商品库库存不足')
+    except Exception:
+        release_reservation(order_id)
+        raise
+
+    cold_skus = [sku for sku in skus if sku.id in cold_counts]
+    if cold_skus:
+        _sold(cold_skus, cold_counts)
+    return order
+
+
+def settle_reserved_stock():
+    """将已扣减的预留库存批量写入数据库的库存和销量，返回结算的商品数
+
+    结算中途失败时结算中的数据保留，下次继续结算; 批次id与库存修改在同一个事务中写入数据库，
+    写入数据库后、删除结算中的数据前中断时，下次不会重复修改库存和销量
+    上一次结算还未结束时跳过
+    """
+    lock = get_user_store().lock(SETTLE_LOCK_KEY, timeout=settings.STOCK_RESERVE_SETTLE_INTERVAL * 10)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        return _settle_reserved_stock()
+    finally:
+        lock.release()
+
+
+def _settle_reserved_stock():
+    """结算一批预留库存，返回结算的商品数"""
+    items = user_store_script(SETTLE_BEGIN_LUA)(keys=[PENDING_KEY, SETTLING_KEY, SETTLING_BATCH_KEY],
+                                                args=[uuid.uuid4().hex])
+    if not items:
+        return 0
+    batch_id = items[0].decode()
+    counts = {int(items[i]): int(items[i + 1]) for i in range(1, len(items), 2) if int(items[i + 1]) != 0}
+    if counts:
+        try:
+            with transaction.atomic():
+                StockSettlement.objects.create(batch_id=batch_id)
+                GoodsSKU.objects.filter(id__in=counts.keys()).update(stock=F('stock') - _count_case(counts),
+                                                                     sales=F('sales') + _count_case(counts))
+        except IntegrityError:
+            # 批次已写入数据库，上次结算在删除结算中的数据前中断
+            pass
+    get_user_store().delete(SETTLING_KEY, SETTLING_BATCH_KEY)
+
+    if counts:
+        # update 不触发信号，同步商品缓存、库存镜像及销量排序
+        delete_sku_cache(*counts.keys())
+        incr_sku_stock({sku_id: -count for sku_id, count in counts.items()})
+        skus = GoodsSKU.objects.filter(id__in=counts.keys()).only('id', 'type')
+        incr_sales_rank([(sku.type_id, sku.id, counts[sku.id]) for sku in skus])
+    return len(counts)
+
+
+def check_reserve_stock(sku_ids=None):
+    """对账: 返回 [(商品id, redis中的可用库存, 数据库库存 - 未结算数量)]
+
+    sku_ids 为None时检查全部已加载的商品; 结算任务运行期间结果可能短暂不一致，应在低峰期或多次检查
+    """
+    con = get_user_store()
+    if sku_ids is None:
+        prefix = reserve_key('')
+        sku_ids = []
+        for key in con.scan_iter(match=prefix + '*', count=1000):
+            sku_id = key.decode()[len(prefix):]
+            if sku_id.isdigit():
+                sku_ids.append(int(sku_id))
+    pending = _pending_counts(PENDING_KEY)
+    settling = _pending_counts(SETTLING_KEY)
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return []
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    result = []
+    for sku_id, reserved in zip(sku_ids, con.mget([reserve_key(sku_id) for sku_id in sku_ids])):
+        if reserved is None or sku_id not in stocks:
+            continue
+        expected = stocks[sku_id] - pending.get(sku_id, 0) - settling.get(sku_id, 0)
+        result.append((sku_id, int(reserved), expected))
+    return result
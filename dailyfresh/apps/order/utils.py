@@ -0,0 +1,321 @@
+from datetime import datetime
+from functools import reduce
+import operator
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction, OperationalError
+from django.core.cache import cache
+from django.db.models import F, Q, Case, When, Value, Count, Prefetch, ExpressionWrapper, IntegerField, CharField, \
+    DecimalField
+from goods.models import GoodsSKU
+from goods.utils import delete_sku_cache
+from goods.rank import incr_sales_rank
+from cart.utils import incr_sku_stock
+from order.models import OrderInfo, OrderGoods
+from utils.paginator import CountedPaginator
+from utils.user_store import get_user_store, user_store_key
+
+
+# 异步下单已进入队列，等待处理
+ORDER_QUEUED = 8
+
+
+class OrderError(Exception):
+    """下单失败，res、errmsg 直接返回给前端"""
+
+    def __init__(self, res, errmsg):
+        super(OrderError, self).__init__(errmsg)
+        self.res = res
+        self.errmsg = errmsg
+
+
+def _count_case(counts):
+    """按商品id取出下单数量的 CASE 表达式"""
+    return Case(*[When(id=sku_id, then=Value(count)) for sku_id, count in counts.items()],
+                output_field=IntegerField())
+
+
+class _StockConflict(Exception):
+    """乐观锁下单时条件更新失败，需要重新读取商品后重试"""
+
+
+def _new_order_id(user):
+    """订单id: 时间(精确到微秒)+用户id，同一用户连续下单也不会重复"""
+    return datetime.now().strftime('%Y%m%d%H%M%S%f') + str(user.id)
+
+
+def _check_skus(skus, sku_ids, counts):
+    """校验商品都存在、在购物车中且库存充足，返回 {商品id: 数量}, 商品总件数, 商品总价"""
+    if len(skus) != len(sku_ids):
+        raise OrderError(4, '商品不存在')
+    sku_counts = {}
+    total_count = 0
+    total_price = 0
+    for sku in skus:
+        count = counts.get(sku.id)
+        if count is None:
+            raise OrderError(4, '商品不在购物车中')
+        # 判断商品库存
+        if count > sku.stock:
+            raise OrderError(6, '商品库库存不足')
+        sku_counts[sku.id] = count
+        total_count += count
+        total_price += sku.price * count
+    return sku_counts, total_count, total_price
+
+
+def _decrease_stock(sku_counts):
+    """减少库存、增加销量，每个商品都带上 stock >= 数量 的条件，一条语句完成; 返回是否全部商品都更新成功"""
+    condition = reduce(operator.or_, [Q(id=sku_id, stock__gte=count) for sku_id, count in sku_counts.items()])
+    updated = GoodsSKU.objects.filter(condition).update(stock=F('stock') - _count_case(sku_counts),
+                                                        sales=F('sales') + _count_case(sku_counts))
+    return updated == len(sku_counts)
+
+
+def _create_order_rows(user, addr, pay_method, skus, sku_counts, total_count, total_price, transit_price,
+                       order_id=None):
+    """写入订单及订单商品"""
+    order = OrderInfo.objects.create(
+        order_id=order_id or _new_order_id(user),
+        user=user,
+        addr=addr,
+        pay_method=pay_method,
+        total_count=total_count,
+        total_price=total_price + transit_price,
+        transit_price=transit_price,
+    )
+    OrderGoods.objects.bulk_create([OrderGoods(order=order, sku=sku, count=sku_counts[sku.id], price=sku.price)
+                                    for sku in skus])
+    return order
+
+
+def _sold(skus, counts):
+    """下单事务提交后同步redis中的数据
+
+    库存和销量通过 update 修改，不会触发 post_save 信号(也不会触发haystack实时索引)，
+    在这里扣减商品库存镜像中的库存、删除商品缓存，并增加销量排序集合中的分值
+    """
+    sku_ids = [sku.id for sku in skus]
+    incr_sku_stock({sku.id: -counts[sku.id] for sku in skus})
+    delete_sku_cache(*sku_ids)
+    incr_sales_rank([(sku.type_id, sku.id, counts[sku.id]) for sku in skus])
+
+
+def create_order(user, addr, pay_method, sku_ids, counts, transit_price=10):
+    """创建订单--悲观锁
+
+    counts: {商品id: 购物车中的数量}
+    一条 SELECT ... FOR UPDATE 按id顺序锁住全部商品，并发订单加锁顺序相同不会死锁;
+    订单商品一次 bulk_create，库存和销量一条带条件的 UPDATE 修改，持有锁的时间不随商品数增加
+    失败时抛出 OrderError，成功返回订单
+    """
+    sku_ids = sorted(set(int(sku_id) for sku_id in sku_ids))
+    with transaction.atomic():
+        # 悲观锁，解决sql并发
+        skus = list(GoodsSKU.objects.select_for_update().filter(id__in=sku_ids).order_by('id'))
+        sku_counts, total_count, total_price = _check_skus(skus, sku_ids, counts)
+        order = _create_order_rows(user, addr, pay_method, skus, sku_counts, total_count, total_price, transit_price)
+        if not _decrease_stock(sku_counts):
+            raise OrderError(6, '商品库库存不足')
+
+    _sold(skus, sku_counts)
+    return order
+
+
+def create_order_optimistic(user, addr, pay_method, sku_ids, counts, transit_price=10):
+    """创建订单--乐观锁
+
+    读取商品时不加锁，库存由带条件的 UPDATE ... WHERE stock >= 数量 保证不会超卖;
+    条件更新成功后才写入订单及订单商品，失败(其他订单先减少了库存)或死锁时回滚，
+    随机等待一段时间后重新读取商品，最多尝试 ORDER_OPTIMISTIC_RETRIES 次
+    """
+    sku_ids = sorted(set(int(sku_id) for sku_id in sku_ids))
+    for attempt in range(settings.ORDER_OPTIMISTIC_RETRIES):
+        try:
+            with transaction.atomic():
+                skus = list(GoodsSKU.objects.filter(id__in=sku_ids).order_by('id'))
+                sku_counts, total_count, total_price = _check_skus(skus, sku_ids, counts)
+                if not _decrease_stock(sku_counts):
+                    raise _StockConflict()
+                order = _create_order_rows(user, addr, pay_method, skus, sku_counts, total_count, total_price,
+                                           transit_price)
+        except (_StockConflict, OperationalError):
+            # 随机退避，避免冲突的请求同时重试再次冲突
+            time.sleep(random.uniform(0, settings.ORDER_RETRY_JITTER * (attempt + 1)))
+            continue
+        _sold(skus, sku_counts)
+        return order
+    raise OrderError(7, '下单失败')
+
+
+# 下单方式，settings.ORDER_COMMIT_MODE 选择
+ORDER_COMMIT_MODES = {
+    'pessimistic': create_order,
+    'optimistic': create_order_optimistic,
+}
+
+
+def commit_order(user, addr, pay_method, sku_ids, counts, mode=None):
+    """按下单方式创建订单，mode 默认为 ORDER_COMMIT_MODE; 订单中有预留库存的热点商品时在redis中扣减库存
+
+    在线支付的订单加入支付截止时间集合，超时未支付时取消; 货到付款的订单不会超时取消
+    """
+    from order.reservation import reserved_sku_ids, create_order_reserved  # 避免循环导入
+
+    if reserved_sku_ids(sku_ids):
+        # 截止时间与预留库存一起写入; 货到付款的订单到期时不取消，只确认预留的库存
+        order = create_order_reserved(user, addr, pay_method, sku_ids, counts)
+    else:
+        order = ORDER_COMMIT_MODES[mode or settings.ORDER_COMMIT_MODE](user, addr, pay_method, sku_ids, counts)
+        if int(pay_method) != 1:
+            schedule_expiry({order.order_id: order_deadline()})
+    delete_order_summary(user.id)
+    return order
+
+
+# 未支付的订单，分值为支付截止时间
+ORDER_DEADLINES_KEY = user_store_key('order_deadlines')
+
+
+def order_deadline(create_time=None):
+    """订单的支付截止时间(时间戳)"""
+    created = create_time.timestamp() if create_time else time.time()
+    return int(created) + settings.ORDER_PAY_TIMEOUT
+
+
+def schedule_expiry(deadlines, client=None):
+    """将未支付订单加入截止时间集合，deadlines: {订单id: 截止时间}; 超时后由 expire_unpaid_orders 取消"""
+    if not deadlines:
+        return
+    args = []
+    for order_id, deadline in deadlines.items():
+        args.extend([deadline, order_id])
+    (client or get_user_store()).zadd(ORDER_DEADLINES_KEY, *args)
+
+
+def _ticket_key(ticket):
+    """异步下单凭证的键"""
+    return user_store_key('order_ticket_%s' % ticket)
+
+
+def new_order_ticket(user_id):
+    """异步下单时生成凭证，记录为处理中"""
+    ticket = uuid.uuid4().hex
+    pipe = get_user_store().pipeline()
+    pipe.hmset(_ticket_key(ticket), {'user_id': user_id, 'res': ORDER_QUEUED})
+    pipe.expire(_ticket_key(ticket), settings.ORDER_TICKET_TTL)
+    pipe.execute()
+    return ticket
+
+
+def set_ticket_result(ticket, res, message, order_id=''):
+    """记录异步下单的结果"""
+    pipe = get_user_store().pipeline()
+    pipe.hmset(_ticket_key(ticket), {'res': res, 'message': message, 'order_id': order_id})
+    pipe.expire(_ticket_key(ticket), settings.ORDER_TICKET_TTL)
+    pipe.execute()
+
+
+def get_ticket_result(ticket, user_id):
+    """读取异步下单的结果 {'res', 'message', 'order_id'}，凭证不存在或不属于该用户时返回None"""
+    result = {key.decode(): value.decode() for key, value in get_user_store().hgetall(_ticket_key(ticket)).items()}
+    if result.get('user_id') != str(user_id):
+        return None
+    return {'res': int(result['res']), 'message': result.get('message', ''), 'order_id': result.get('order_id', '')}
+
+
+def order_event_channel(order_id):
+    """订单支付结果的发布频道，/order/check 订阅后等待"""
+    return user_store_key('order_event_%s' % order_id)
+
+
+def order_paid(order, trade_no):
+    """订单支付成功: 保存支付宝交易号，状态改为待评价，确认订单预留的库存，并发布支付结果
+
+    只更新未支付的订单，异步通知和主动查询重复到达时只处理一次; 返回是否更新了订单
+    """
+    if not orders_paid({order.order_id: trade_no}):
+        return False
+    order.trade_no = trade_no
+    order.order_status = 4  # 待评价
+    return True
+
+
+def orders_paid(trade_nos):
+    """批量处理支付成功的订单，trade_nos: {订单id: 支付宝交易号}; 返回更新的订单id列表
+
+    一条 UPDATE 写入交易号并改为待评价，只更新仍未支付的订单
+    """
+    from order.reservation import confirm_reservations  # reservation 模块依赖本模块，在函数中导入避免循环导入
+
+    if not trade_nos:
+        return []
+    with transaction.atomic():
+        orders = dict(OrderInfo.objects.select_for_update()
+                      .filter(order_id__in=trade_nos.keys(), order_status=1)
+                      .values_list('order_id', 'user_id'))
+        order_ids = list(orders)
+        if order_ids:
+            OrderInfo.objects.filter(order_id__in=order_ids).update(
+                order_status=4,  # 待评价
+                trade_no=Case(*[When(order_id=order_id, then=Value(trade_nos[order_id])) for order_id in order_ids],
+                              output_field=CharField()))
+    if order_ids:
+        confirm_reservations(order_ids)
+        delete_order_summary(*set(orders.values()))
+        pipe = get_user_store().pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.publish(order_event_channel(order_id), 4)
+        pipe.execute()
+    return order_ids
+
+
+def _order_summary_key(user_id):
+    """用户订单统计缓存的键"""
+    return 'order_summary_%s' % user_id
+
+
+def get_order_summary(user_id):
+    """获取用户的订单统计 {'count': 订单总数, 'status': {订单状态: 订单数}}
+
+    一次 GROUP BY 查询后缓存，订单创建或状态修改时删除
+    """
+    summary = cache.get(_order_summary_key(user_id))
+    if summary is None:
+        status = dict(OrderInfo.objects.filter(user_id=user_id).order_by()
+                      .values_list('order_status').annotate(Count('order_id')))
+        summary = {'count': sum(status.values()), 'status': status}
+        cache.set(_order_summary_key(user_id), summary, settings.ORDER_SUMMARY_TTL)
+    return summary
+
+
+def delete_order_summary(*user_ids):
+    """用户的订单创建或状态修改时删除订单统计的缓存"""
+    cache.delete_many([_order_summary_key(user_id) for user_id in user_ids])
+
+
+def get_user_order_page(user_id, page):
+    """获取用户中心订单页某一页的订单
+
+    订单总数取自缓存的订单统计，不执行 COUNT(*); 数据库只取当前页的订单，
+    当前页所有订单的商品一次查询取出(连带商品信息)，小计在SQL中计算。
+    返回 paginator, order_pages, 订单统计
+    """
+    order_skus = OrderGoods.objects.select_related('sku').annotate(
+        amount=ExpressionWrapper(F('price') * F('count'), output_field=DecimalField(max_digits=10, decimal_places=2)))
+    orders = OrderInfo.objects.filter(user_id=user_id).order_by('-create_time', '-order_id').prefetch_related(
+        Prefetch('ordergoods_set', queryset=order_skus, to_attr='order_skus'))
+
+    summary = get_order_summary(user_id)
+    paginator = CountedPaginator(orders, settings.ORDER_PAGE_SIZE, summary['count'])
+    # 传入的page大于最大值
+    if page < 1 or page > paginator.num_pages:
+        page = 1
+    order_pages = paginator.page(page)
+    for order in order_pages:
+        # 动态添加属性，保存订单支付状态
+        order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
+    return paginator, order_pages, summary
@@ -3,19 +3,28 @@ from django.views.generic import View
 from django.core.urlresolvers import reverse
 from django.http import JsonResponse, HttpResponse
 from django.conf import settings
-from django_redis import get_redis_connection
 from django.db import transaction
-from datetime import datetime
+from django.db.models import F
+from decimal import Decimal, InvalidOperation
+import logging
 import time
 
 from goods.models import GoodsSKU
+from goods.utils import get_skus
+from cart.utils import cart_remove, cart_counts
 from user.models import Address
 from order.models import OrderInfo, OrderGoods
-from utils.pay.alipay import alipay_trade_page, alipay_trade_query
+from order.utils import commit_order, OrderError, order_paid, order_event_channel, new_order_ticket, get_ticket_result, \
+    delete_order_summary, ORDER_QUEUED
+from celery_tasks.tasks import place_order
+from utils.pay.alipay import alipay_trade_page, alipay_trade_query, alipay_verify_notify
+from utils.user_store import get_user_store
 
 from utils.mixin import LoginRequiredMixin
 # Create your views here.
 
+logger = logging.getLogger(__name__)
+
 
 # /order/place
 class OrderPlaceView(LoginRequiredMixin, View):
@@ -32,20 +41,20 @@ class OrderPlaceView(LoginRequiredMixin, View):
         if not sku_ids:
             # 数据为空，返回订单页
             return redirect(reverse('cart：show'))
-        # 连接缓存数据库，获取购物车记录
-        con = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
         # 返回的商品集合，商品总件数，总价格
         skus = []
         total_count = 0
         total_amount = 0
 
-        for sku_id in sku_ids:
-            # 获取用户商品信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 读取购物车中商品数量
-            count = con.hget(cart_key, sku_id)
+        # 一次读取购物车中这些商品的数量
+        counts = dict(zip(sku_ids, cart_counts(user.id, sku_ids)))
+        # 一次取出所有商品,不存在或已下线的商品跳过
+        for sku in get_skus(sku_ids, online_only=True):
+            # 读取购物车中商品数量,不在购物车中的商品跳过
+            count = counts[str(sku.id)]
+            if count is None:
+                continue
+            count = int(count)
             # 商品小计
             amount = sku.price * int(count)
             # 动态将商品添加count amount 属性
@@ -64,8 +73,8 @@ class OrderPlaceView(LoginRequiredMixin, View):
         # 获取用户所有地址
         addrs = Address.objects.filter(user=user)
 
-        # 存储用户订单商品id [1,2]
-        sku_ids = ','.join(sku_ids)
+        # 存储用户订单商品id [1,2],只包含有效的商品
+        sku_ids = ','.join(str(sku.id) for sku in skus)
         # 组织上下文
         context = {
             'skus': skus,
@@ -83,8 +92,9 @@ class OrderPlaceView(LoginRequiredMixin, View):
 
 # /order/commit   地址id，支付方式id， 商品id
 class OrderCommitView(View):
-    """订单创建--悲观锁"""
-    @transaction.atomic  # 装饰方法，对函数中的sql操作都封装在一个事物中
+    """订单创建，默认使用 ORDER_COMMIT_MODE 配置的下单方式(悲观锁或乐观锁)"""
+    mode = None
+
     def post(self, request):
         """订单创建"""
         # 判断用户是否登陆
@@ -110,81 +120,54 @@ class OrderCommitView(View):
         except Address.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '地址非法'})
 
-        # todo:创建订单，组织参数
-        # 订单id  20191111000001（时间）+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)  # 主键
-        transit_price = 10
-        total_count = 0
-        total_price = 0
-        # 建立sql事务中的保存点，以便后续操作失败回滚
-        save_id = transaction.savepoint()
+        # 将获得的商品id字符串，转化成id列表
         try:
-            # todo:向df_order_info表中添加一条记录
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user=user,
-                addr=addr,
-                pay_method=pay_method,
-                total_count=total_count,
-                total_price=total_price,
-                transit_price=transit_price,
-            )
-
-            # todo:有几个商品就向df_order_goods添加几条数据
-            # 将获得的商品id字符串，转化成id列表
-            sku_ids = sku_ids.split(',')
-            # 连接缓存数据库，获取购物车记录
-            con = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            for sku_id in sku_ids:
-                try:
-                    # 悲观锁，解决sql并发
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
-                    # sql数据库操作回滚
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-                # 商品数量
-                count = con.hget(cart_key, sku_id)
-                # todo:判断商品库存
-                if int(count) > sku.stock:
-                    # sql数据库操作回滚
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 6, 'errmsg': '商品库库存不足'})
-
-                # todo:向df_order_goods创建一条记录
-                OrderGoods.objects.create(
-                    order=order,
-                    sku=sku,
-                    count=count,
-                    price=sku.price,
-                )
-                # todo：更商品新库存和销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # 总数量和总价格
-                amount = sku.price*int(count)
-                total_count += int(count)
-                total_price += amount
-
-            # todo:更新订单记录中的total_count，total_count
-            order.total_count = total_count
-            order.total_price = total_price + order.transit_price
-            order.save()
+            sku_ids = [int(sku_id) for sku_id in sku_ids.split(',')]
+        except ValueError:
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+        # 一次读取购物车中这些商品的数量
+        counts = dict(zip(sku_ids, cart_counts(user.id, sku_ids)))
+
+        if None in counts.values():
+            return JsonResponse({'res': 4, 'errmsg': '商品不在购物车中'})
+
+        if settings.ORDER_COMMIT_ASYNC:
+            # 异步下单：只做上面的简单校验，放入下单队列后立即返回凭证，前端通过 /order/status 查询结果
+            ticket = new_order_ticket(user.id)
+            place_order.delay(ticket, user.id, addr.id, pay_method, sku_ids, list(counts.items()), self.mode)
+            return JsonResponse({'res': ORDER_QUEUED, 'ticket': ticket, 'message': '订单处理中'})
+
+        # todo:创建订单，一个事务中创建订单及订单商品、更新库存和销量
+        try:
+            commit_order(user, addr, pay_method, sku_ids, counts, self.mode)
+        except OrderError as e:
+            return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
         except Exception as e:
-            # sql数据库操作回滚
-            transaction.savepoint_rollback(save_id)
             return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-        # 提交，保存事务
-        transaction.savepoint_commit(save_id)
         # todo:清除购物车中已购买商品信息
-        con.hdel(cart_key, *sku_ids)  # *list[]----拆包，把数据元素一个一个拿出来
+        cart_remove(user.id, sku_ids)
 
         return JsonResponse({'res': 5, 'message': '创建成功'})
 
 
+# /order/status?ticket=凭证
+class OrderStatusView(View):
+    """查询异步下单的结果，只读取redis"""
+    def get(self, request):
+        user = request.user
+        # 未登陆无法操作
+        if not user.is_authenticated():
+            return JsonResponse({'res': 0, 'errmsg': '请先登陆'})
+
+        ticket = request.GET.get('ticket')
+        result = get_ticket_result(ticket, user.id) if ticket else None
+        if result is None:
+            return JsonResponse({'res': 1, 'errmsg': '无效的下单凭证'})
+        # res: 5 创建成功, 8 处理中, 其他为下单失败的错误码
+        return JsonResponse({'res': result['res'], 'errmsg': result['message'], 'message': result['message'],
+                             'order_id': result['order_id']})
+
+
 # /order/pay 收款，返回支付宝支付地址
 class OrderPayView(View):
     """订单支付"""
@@ -224,7 +207,11 @@ class OrderPayView(View):
 class CheckPayView(View):
     """检查支付是否成功"""
     def post(self, request):
-        """检查支付是否成功"""
+        """检查支付是否成功
+
+        订单已有结果时立即返回，否则订阅支付结果最多等待 ORDER_CHECK_WAIT 秒(只占用worker很短的时间)，
+        超时后主动查询一次支付宝，仍未支付时返回 res 6 由页面逐渐延长间隔再次请求，不在服务器中循环等待
+        """
         # 用户是否登陆
         user = request.user
         # 未登陆无法操作
@@ -237,59 +224,92 @@ class CheckPayView(View):
         if not order_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的订单编号'})
 
+        # 先订阅支付结果再读取订单状态，不会错过两者之间发布的结果
+        pubsub = get_user_store().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(order_event_channel(order_id))
         try:
-            order = OrderInfo.objects.get(order_id=order_id,
-                                          user=user,
-                                          pay_method=3,
-                                          order_status=1, )
-        except OrderInfo.DoesNotExist:
-            return JsonResponse({'res': 2, 'errmsg': '订单错误'})
-
-        # 不停的查询，直到支付成功或失败
-        while True:
-
-            # todo:支付宝支付结果查询
-            # 支付宝返回的查询结果
+            try:
+                order = OrderInfo.objects.get(order_id=order_id,
+                                              user=user,
+                                              pay_method=3, )
+            except OrderInfo.DoesNotExist:
+                return JsonResponse({'res': 2, 'errmsg': '订单错误'})
+
+            status = order.order_status
+            deadline = time.time() + settings.ORDER_CHECK_WAIT
+            while status == 1:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                message = pubsub.get_message(timeout=timeout)
+                if message is not None:
+                    status = int(message['data'])
+        finally:
+            pubsub.close()
+
+        if status == 1:
+            # 没有收到异步通知(如支付宝无法访问通知地址)，主动查询一次
             response = alipay_trade_query(order)
             if response is None:
                 return JsonResponse({'res': 4, 'errmsg': '与支付宝对接错误'})
 
-            # 返回值
-            # code: 10000  # 接口调用成功
-            # msg: Success
-            # buyer_logon_id: rlf ** * @ sandbox.com
-            # buyer_pay_amount: 0.00
-            # buyer_user_id: 2088102179299453
-            # buyer_user_type: PRIVATE
-            # invoice_amount: 0.00
-            # out_trade_no: 201908061630378  #自己传入的订单id
-            # point_amount: 0.00
-            # receipt_amount: 0.00
-            # send_pay_date: 2019 - 0
-            # 8 - 06
-            # 16: 31:15
-            # total_amount: 39.90
-            # trade_no: 2019080622001499451000022039  # 支付宝交易id
-            # trade_status: TRADE_SUCCESS  # 交易状态
-
             # 如果调用业务成功,且支付成功
-            if response.code == '10000' and response.trade_status == 'TRADE_SUCCESS':
-                # 获取支付宝交易号
-                trade_no = response.trade_no
-                order.trade_no = trade_no
-                order.order_status = 4  # 待评价
-                order.save()
-                return JsonResponse({'res': 3, 'message': '支付成功'})
+            if response.code == '10000' and response.trade_status in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+                # 获取支付宝交易号，保存交易号并修改订单状态; 已被异步通知处理时重新读取状态
+                if not order_paid(order, response.trade_no):
+                    order.refresh_from_db(fields=['order_status'])
+                    if order.order_status == 6:
+                        logger.error('order %s paid after cancelled, trade_no: %s, refund required',
+                                     order.order_id, response.trade_no)
+                status = order.order_status
 
             elif response.code == '40004' or (response.code == '10000' and response.trade_status == 'WAIT_BUYER_PAY'):
-                # 业务还为调用成功但可能会成功或调用业务成功,等待支付成功
-                time.sleep(5)
-                continue
+                # 交易还未创建或等待买家付款，页面稍后再次查询
+                return JsonResponse({'res': 6, 'errmsg': '等待支付'})
 
             else:
                 # 支付出错
                 return JsonResponse({'res': 5, 'message': '支付出错'})
 
+        if status == 6:
+            return JsonResponse({'res': 7, 'errmsg': '订单已取消'})
+        return JsonResponse({'res': 3, 'message': '支付成功'})
+
+
+# /order/notify
+class AlipayNotifyView(View):
+    """支付宝异步通知支付结果"""
+    def post(self, request):
+        """验证签名后更新订单并发布支付结果，返回 success 后支付宝不再重复通知"""
+        params = request.POST.dict()
+        if not alipay_verify_notify(params):
+            return HttpResponse('failure')
+
+        # 交易创建、关闭等其他状态的通知不处理
+        if params.get('trade_status') not in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+            return HttpResponse('success')
+
+        try:
+            order = OrderInfo.objects.get(order_id=params.get('out_trade_no'), pay_method=3)
+        except OrderInfo.DoesNotExist:
+            return HttpResponse('failure')
+
+        # 支付金额与订单金额不一致
+        try:
+            if Decimal(params.get('total_amount')) != order.total_price:
+                return HttpResponse('failure')
+        except (TypeError, InvalidOperation):
+            return HttpResponse('failure')
+
+        # 重复的通知不会再次修改订单
+        if not order_paid(order, params.get('trade_no')):
+            order.refresh_from_db(fields=['order_status'])
+            if order.order_status == 6:
+                # 超时取消后才支付成功，库存已恢复，需要人工退款
+                logger.error('order %s paid after cancelled, trade_no: %s, refund required',
+                             order.order_id, params.get('trade_no'))
+        return HttpResponse('success')
+
 
 # /order/comment
 class OrderCommentView(View):
@@ -350,10 +370,13 @@ class OrderCommentView(View):
         except OrderGoods.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '该订单商品不存在'})
 
-        # 评论提交
-
-        order_goods.comment = comment_text
-        order_goods.save()
+        # 评论提交,首次评论时商品的评论数量加1; 锁定订单商品，并发提交时只有第一次计数
+        with transaction.atomic():
+            order_goods = OrderGoods.objects.select_for_update().get(id=order_goods.id)
+            if order_goods.comment in ('', 'False'):
+                GoodsSKU.objects.filter(id=order_goods.sku_id).update(comment_count=F('comment_count') + 1)
+            order_goods.comment = comment_text
+            order_goods.save()
 
         # 获取商品所在的订单
         try:
@@ -372,119 +395,11 @@ class OrderCommentView(View):
         if order_is_commentted is True:
             order.order_status = 5
             order.save()
+            delete_order_summary(order.user_id)
 
         return redirect(reverse('user:order', kwargs={'page': 1}))
 
 
-
-class OrderCommitView2(View):
-    """订单创建--乐观锁"""
-    def post(self, request):
-        """订单创建"""
-        # 判断用户是否登陆
-        user = request.user
-        # 未登陆无法操作
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登陆'})
-        # 获取数据
-        sku_ids = request.POST.get('sku_ids')  # 商品id ，字符串 1，2
-        pay_method = request.POST.get('pay_method')
-        addr_id = request.POST.get('addr_id')
-
-        # 校验参数
-        if not all([sku_ids, pay_method, addr_id]):
-            # print(sku_ids+':'+pay_method+':'+addr_id)
-            return JsonResponse({'res': 1, 'errmsg': '参数不完整'})
-
-        if pay_method not in OrderInfo.PAY_METHOD.keys():
-            return JsonResponse({'res': 2, 'errmsg': '非法的支付方式'})
-
-        try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            return JsonResponse({'res': 3, 'errmsg': '地址非法'})
-
-        # todo:创建订单，组织参数
-        # 订单id  20191111000001（时间）+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)  # 主键
-        transit_price = 10
-        total_count = 0
-        total_price = 0
-        # 建立sql事务中的保存点，以便后续操作失败回滚
-        save_id = transaction.savepoint()
-        try:
-            # todo:向df_order_info表中添加一条记录
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user=user,
-                addr=addr,
-                pay_method=pay_method,
-                total_count=total_count,
-                total_price=total_price,
-                transit_price=transit_price,
-            )
-
-            # todo:有几个商品就向df_order_goods添加几条数据
-            # 将获得的商品id字符串，转化成id列表
-            sku_ids = sku_ids.split(',')
-            # 连接缓存数据库，获取购物车记录
-            con = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            for sku_id in sku_ids:
-                for i in range[3]:
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        # sql数据库操作回滚
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
-                    # 商品数量
-                    count = con.hget(cart_key, sku_id)
-                    # todo:判断商品库存
-                    if int(count) > sku.stock:
-                        # sql数据库操作回滚
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库库存不足'})
-
-                    # todo:向df_order_goods创建一条记录
-                    OrderGoods.objects.create(
-                        order=order,
-                        sku=sku,
-                        count=count,
-                        price=sku.price,
-                    )
-                    # todo：更商品新库存和销量----使用悲观锁解决并发问题
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - int(count)
-                    new_sales = sku.sales + origin_stock
-                    # 返回受影响的行数
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        # sql数据库操作回滚
-                        if i == 2:  # 尝试三次都失败，则真的失败
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-                        continue
-
-                    # 总数量和总价格
-                    amount = sku.price*int(count)
-                    total_count += int(count)
-                    total_price += amount
-
-                    # 修改数据库成功，跳出循环
-                    break
-
-            # todo:更新订单记录中的total_count，total_count
-            order.total_count = total_count
-            order.total_price = total_price + order.transit_price
-            order.save()
-        except Exception as e:
-            # sql数据库操作回滚
-            transaction.savepoint_rollback(save_id)
-            return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-        # 提交，保存事务
-        transaction.savepoint_commit(save_id)
-        # todo:清除购物车中已购买商品信息
-        con.hdel(cart_key, *sku_ids)  # *list[]----拆包，把数据元素一个一个拿出来
-
-        return JsonResponse({'res': 5, 'message': '创建成功'})
\ No newline at end of file
+class OrderCommitView2(OrderCommitView):
+    """订单创建--乐观锁，不受 ORDER_COMMIT_MODE 影响，可以单独配置路由"""
+    mode = 'optimistic'
@@ -1,17 +1,16 @@
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse   # 重定向页面，需要使用反向解析
 from django.conf import settings
-from django.core.paginator import Paginator
 from django.http import HttpResponse
 from django.contrib.auth import authenticate, login, logout
 from django.views.generic import View
 
 from celery_tasks.tasks import send_register_active_email
 from user.models import User, Address
-from goods.models import GoodsSKU
-from order.models import OrderInfo, OrderGoods
+from goods.utils import get_skus
+from cart.utils import get_cart_id, cart_merge
+from order.utils import get_user_order_page
 from utils.mixin import LoginRequiredMixin  # 登陆验证装饰器
-from django_redis import get_redis_connection
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer  # 使用itsdangerous进行激活加密
 from itsdangerous import SignatureExpired
@@ -126,8 +125,13 @@ class LoginView(View):
             # 登陆成功
             if user.is_active:
                 # 用户已激活
+                # 未登陆时的购物车，login 会更换session_key，需要先取出
+                anon_cart_id = get_cart_id(request, create=False)
                 # 记录用户的登陆状态,同样使用django提供的记录用户登陆状态的login，应该会在浏览器写一些cookie
                 login(request, user)
+                # 在一个脚本中将未登陆时的购物车合并到用户购物车
+                if anon_cart_id is not None:
+                    cart_merge(user.id, anon_cart_id)
 
                 # 获取登陆后要跳转的地址
                 # 如果next返回值不是None则，接受返回值，否则接受自定义值
@@ -180,17 +184,11 @@ class UserInfoView(LoginRequiredMixin, View):
         address = Address.objects.get_default_address(user)
         # 获取用户浏览记录
         # 在redis中,以list格式存储
-        con = get_redis_connection('default')  # 使用django-redis默认连接redis方法
-        history_key = 'history_%d' % user.id  # 用户浏览数据键的名
-
         # 获取最近浏览的5个商品信息
-        sku_ids = con.lrange(history_key, 0, 4)  # 返回浏览商品的sku ID 列表
+        sku_ids = request.user_state.get_history()  # 返回浏览商品的sku ID 列表
 
-        # 从数据库读取商品信息
-        goods_list = []
-        for id in sku_ids:
-            goods = GoodsSKU.objects.get(id=id)
-            goods_list.append(goods)
+        # 从数据库读取商品信息,一次取出并保持浏览顺序,不存在或已下线的商品跳过
+        goods_list = get_skus(sku_ids, online_only=True)
 
         # 组织上下文
         context = {'page': 'user',
@@ -212,36 +210,15 @@ class UserOrderView(LoginRequiredMixin, View):
         # 读取用户信息
         user = request.user
 
-        # 获取该用户所有订单信息
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
-        for order in orders:
-            # 单个订单，得到所有订单商品
-            order_skus = OrderGoods.objects.filter(order=order)
-            # 计算每个商品的小计
-            for order_sku in order_skus:
-                # 计算小计
-                amount = order_sku.price*order_sku.count
-                # 动态添加属性amount,保存小计
-                order_sku.amount = amount
-
-            # 动态添加属性，保存订单支付状态
-            order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            # 动态添加属性，保存订单的商品信息
-            order.order_skus = order_skus
-
-        # 分页
-        paginator = Paginator(orders, 1)
         # 判断传过来的page数据
         try:
             page = int(page)
         except Exception as e:
             page = 1
 
-        # 传入的page大于最大值
-        if page > paginator.num_pages:
-            page = 1
-        # 获取page页数据
-        order_pages = paginator.page(page)
+        # 只查询当前页的订单及其商品
+        paginator, order_pages, order_summary = get_user_order_page(user.id, page)
+        page = order_pages.number
 
         # 进行页码控制，最多只显示5页
         # 1.总页数小于5，显示所有页码
@@ -261,6 +238,7 @@ class UserOrderView(LoginRequiredMixin, View):
         # 上下文
         context = {
             'order_pages': order_pages,
+            'order_summary': order_summary,
             'pages': pages,
             'page': 'order',
             'nginx_url': settings.FDFS_NGINX_URL,
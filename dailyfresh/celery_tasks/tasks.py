@@ -4,19 +4,58 @@ from django.conf import settings
 from django.template import loader
 
 import os
+import time
+import logging
+import tempfile
 import django
 
 # 完成异步任务的建立与中间者broker的创建
 
 # 创建celery实例对象
-apps = Celery('celery_tasks.tasks', broker='redis://127.0.0.1:6379/8')
+# broker使用用户数据redis实例(不淘汰、持久化)的db 1，缓存实例可以自由淘汰
+apps = Celery('celery_tasks.tasks', broker='redis://127.0.0.1:6380/1')
 
 # worker 页需要配置的
 # # 由于任务执行只启动当前py文件，所以需要依赖的系统设置要引入
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 # django.setup()
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.utils import get_index_page_data
+from cart.utils import archive_idle_carts, cart_remove
+from order.reservation import settle_reserved_stock
+from order.expiry import expire_unpaid_orders
+from order.reconcile import reconcile_payments
+from order.utils import commit_order, set_ticket_result, OrderError
+from user.models import User, Address
 from utils.mixin import LoginRequiredMixin  # 登陆验证装饰器
+from utils.user_store import get_user_store, user_store_key
+
+logger = logging.getLogger(__name__)
+
+# 下单任务使用单独的队列，由单独启动的worker处理，不影响其他任务
+apps.conf.task_routes = {
+    'celery_tasks.tasks.place_order': {'queue': 'order'},
+}
+
+# 定时任务，需要另外启动 celery -A celery_tasks.tasks beat
+apps.conf.beat_schedule = {
+    'archive-carts': {
+        'task': 'celery_tasks.tasks.archive_carts',
+        'schedule': settings.CART_ARCHIVE_INTERVAL,
+    },
+    'settle-reserved-stock': {
+        'task': 'celery_tasks.tasks.settle_reserved_stock_task',
+        'schedule': settings.STOCK_RESERVE_SETTLE_INTERVAL,
+    },
+    'expire-unpaid-orders': {
+        'task': 'celery_tasks.tasks.expire_unpaid_orders_task',
+        'schedule': settings.ORDER_EXPIRE_INTERVAL,
+    },
+    'reconcile-payments': {
+        'task': 'celery_tasks.tasks.reconcile_payments_task',
+        'schedule': settings.ALIPAY_RECONCILE_INTERVAL,
+    },
+}
+
 # 定义任务函数
 @apps.task
 def send_register_active_email(to_email, username, token):
@@ -33,44 +72,154 @@ def send_register_active_email(to_email, username, token):
     send_mail(subject, message, from_mail, recipient_list, html_message=html_message)
     # 返回应答, 跳转到首页
 
+# 静态首页重新生成请求的合并与互斥用到的redis键，保存在不淘汰的用户数据redis中
+STATIC_INDEX_PENDING_KEY = user_store_key('static_index_pending')  # 等待中的生成请求数
+STATIC_INDEX_SCHEDULED_KEY = user_store_key('static_index_scheduled')  # 已调度但未开始的生成任务标记
+STATIC_INDEX_LOCK_KEY = user_store_key('static_index_lock')  # 生成互斥锁，同一时间只有一个worker渲染
+STATIC_INDEX_METRICS_KEY = user_store_key('static_index_metrics')  # 生成耗时、合并请求数等统计
+
+
+def request_static_index_html():
+    """请求重新生成静态首页
+
+    后台批量修改数据时会频繁调用，在 STATIC_INDEX_DEBOUNCE 秒的窗口内的多次请求只调度一次生成任务
+    """
+    con = get_user_store()
+    pipe = con.pipeline()
+    pipe.incr(STATIC_INDEX_PENDING_KEY)
+    # 只有第一个请求能设置调度标记，过期时间用于防止worker异常退出后标记一直存在
+    pipe.set(STATIC_INDEX_SCHEDULED_KEY, 1, nx=True, ex=settings.STATIC_INDEX_DEBOUNCE + 60)
+    pending, scheduled = pipe.execute()
+    if scheduled:
+        generate_static_index_html.apply_async(countdown=settings.STATIC_INDEX_DEBOUNCE)
+
+
 # 定义任务函数
 @apps.task
 def generate_static_index_html():
     """生成静态index页"""
-    # 获取商品的种类信息
-    types = GoodsType.objects.all()
-    # 获取首页轮播商品信息
-    goods_banner = IndexGoodsBanner.objects.all().order_by('index')
-    # 获取首页促销活动信息
-    promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
-    # 获取首页分类商品展示信息
-
-    for type in types:
-        # 获取首页type种类的图片展示信息
-        image_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-        # 获取首页type种类的文字展示信息
-        title_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-
-        # python 可以动态的给对象添加属性
-        type.image_banner = image_banner
-        type.title_banner = title_banner
-
-    content = {
-        'types': types,
-        'goods_banner': goods_banner,
-        'promotion_banner': promotion_banner,
-        'nginx_url': settings.FDFS_NGINX_URL
-    }
-
-    # 使用模板生成模板文件----最原始的方法
-    # 1.加载模板文件，生成模板对象
-    temp = loader.get_template('static_index.html')
-    # 2.渲染
-    static_index_html = temp.render(content)
-
-    # 保存路径 static/index.html
-    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
-
-    # 保存文件
-    with open(save_path, 'w') as f:
-        f.write(static_index_html)
+    con = get_user_store()
+    # 清除调度标记，渲染开始后到来的请求会重新调度一次生成
+    con.delete(STATIC_INDEX_SCHEDULED_KEY)
+
+    lock = con.lock(STATIC_INDEX_LOCK_KEY, timeout=60)
+    if not lock.acquire(blocking=False):
+        # 其他worker正在渲染，可能读不到最新数据，稍后再生成一次
+        request_static_index_html()
+        return
+
+    try:
+        # 本次渲染合并的请求数
+        coalesced = int(con.getset(STATIC_INDEX_PENDING_KEY, 0) or 0)
+        start = time.time()
+
+        # 获取首页数据，与IndexView共用
+        content = get_index_page_data()
+
+        # 使用模板生成模板文件----最原始的方法
+        # 1.加载模板文件，生成模板对象
+        temp = loader.get_template('static_index.html')
+        # 2.渲染
+        static_index_html = temp.render(content)
+
+        # 保存路径 static/index.html
+        save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
+
+        # 先写入同目录下的临时文件，再原子替换，nginx不会读到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), prefix='.index.', suffix='.html')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(static_index_html)
+            # mkstemp 创建的文件只有属主可读，nginx需要读取权限
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, save_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        # 记录生成统计
+        render_ms = int((time.time() - start) * 1000)
+        pipe = con.pipeline()
+        pipe.hincrby(STATIC_INDEX_METRICS_KEY, 'renders', 1)
+        pipe.hincrby(STATIC_INDEX_METRICS_KEY, 'requests', coalesced)
+        pipe.hincrby(STATIC_INDEX_METRICS_KEY, 'render_ms_total', render_ms)
+        pipe.hset(STATIC_INDEX_METRICS_KEY, 'last_render_ms', render_ms)
+        pipe.hset(STATIC_INDEX_METRICS_KEY, 'last_coalesced', coalesced)
+        pipe.execute()
+        logger.info('static index rendered in %dms, coalesced %d requests', render_ms, coalesced)
+    finally:
+        lock.release()
+
+
+@apps.task
+def archive_carts():
+    """将长时间未访问的购物车从redis转存到数据库，用户下次访问购物车时恢复"""
+    start = time.time()
+    archived = archive_idle_carts()
+    logger.info('archived %d idle carts in %dms', archived, int((time.time() - start) * 1000))
+
+
+@apps.task
+def settle_reserved_stock_task():
+    """将热点商品已扣减的预留库存批量写入数据库"""
+    settled = settle_reserved_stock()
+    if settled:
+        logger.info('settled reserved stock of %d skus', settled)
+
+
+# 超时取消互斥锁，上一次还未结束时跳过
+EXPIRE_LOCK_KEY = user_store_key('order_expire_lock')
+
+
+@apps.task
+def expire_unpaid_orders_task():
+    """取消超时未支付的订单，恢复库存"""
+    lock = get_user_store().lock(EXPIRE_LOCK_KEY, timeout=settings.ORDER_EXPIRE_INTERVAL * 10)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        start = time.time()
+        cancelled = expire_unpaid_orders()
+        if cancelled:
+            logger.info('cancelled %d unpaid orders in %dms', cancelled, int((time.time() - start) * 1000))
+    finally:
+        lock.release()
+
+
+# 对账互斥锁，上一次对账还未结束时跳过，避免对支付宝的请求速率翻倍
+RECONCILE_LOCK_KEY = user_store_key('alipay_reconcile_lock')
+
+
+@apps.task
+def reconcile_payments_task():
+    """主动查询未支付的支付宝订单，处理没有收到异步通知的已支付订单"""
+    lock = get_user_store().lock(RECONCILE_LOCK_KEY, timeout=settings.ALIPAY_RECONCILE_INTERVAL * 10)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        start = time.time()
+        stats = reconcile_payments()
+        logger.info('reconciled %d orders in %dms: %d paid, %d waiting, %d closed, %d failed', stats['checked'],
+                    int((time.time() - start) * 1000), stats['paid'], stats['waiting'], stats['closed'],
+                    stats['failed'])
+    finally:
+        lock.release()
+
+
+@apps.task
+def place_order(ticket, user_id, addr_id, pay_method, sku_ids, counts, mode=None):
+    """异步下单，counts: [(商品id, 数量)]; 结果写入下单凭证"""
+    try:
+        user = User.objects.get(id=user_id)
+        addr = Address.objects.get(id=addr_id)
+        order = commit_order(user, addr, pay_method, sku_ids, dict(counts), mode)
+    except OrderError as e:
+        set_ticket_result(ticket, e.res, e.errmsg)
+        return
+    except Exception:
+        logger.exception('place order %s failed', ticket)
+        set_ticket_result(ticket, 7, '下单失败')
+        return
+    # 清除购物车中已购买商品信息
+    cart_remove(user_id, sku_ids)
+    set_ticket_result(ticket, 5, '创建成功', order.order_id)
@@ -50,6 +50,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'utils.user_state.UserStateMiddleware',  # 请求中用户购物车、浏览记录的redis操作合并发送
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -132,19 +133,100 @@ EMAIL_HOST_PASSWORD = '[客户端授权密码!!!]'
 EMAIL_FROM = '[your name]<[your email address]>'
 
 # django缓存设置，设置redis作为缓存数据库
+# 缓存只保存可以重新计算的数据(页面数据、版本号、排序集合等)，redis可以配置 maxmemory-policy allkeys-lru 自由淘汰;
+# session、定时任务的锁、首页静态化标记和celery的broker都在下面的用户数据redis中
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
         "LOCATION": "redis://127.0.0.1:6379/9",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "CONNECTION_POOL_KWARGS": {"max_connections": 100},
         }
-    }
+    },
+    # 购物车、浏览记录等需要持久保存的用户数据，使用单独的redis实例(redis_user_store.conf):
+    # 开启AOF持久化、maxmemory-policy noeviction，不会被淘汰，也不会随缓存一起清空
+    "user_store": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6380/0",
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "CONNECTION_POOL_KWARGS": {"max_connections": 50},
+        },
+        # 通过缓存接口保存的数据(session)与其他用户数据使用相同的前缀
+        "KEY_PREFIX": "df",
+    },
 }
 
-# 配置session存储，到redis缓存中
+# 用户数据所在的缓存配置名及键的前缀，用户数据直接通过redis连接读写，前缀需要自己添加
+USER_STORE_ALIAS = 'user_store'
+USER_STORE_KEY_PREFIX = 'df:'
+
+# 首页数据缓存: 软过期时间后由一个请求重建，硬过期时间后缓存删除，软过期前提前刷新的秒数
+INDEX_CACHE_SOFT_TTL = 3600
+INDEX_CACHE_HARD_TTL = 3600 * 24
+INDEX_CACHE_REFRESH_AHEAD = 60
+
+# 进程内本地缓存(两级缓存的第一级)最多保存的键数及过期时间(秒)
+LOCAL_CACHE_MAX_SIZE = 256
+LOCAL_CACHE_TTL = 300
+
+# 商品详情页数据缓存过期时间(秒)，商品修改时通过版本号失效
+DETAIL_CACHE_TTL = 3600
+# 种类商品数量缓存的过期时间(秒)，增量维护出现偏差时最多持续这么久
+TYPE_SKU_COUNT_TTL = 3600
+
+# 商品列表页每页显示的商品数
+GOODS_LIST_PAGE_SIZE = 1
+
+# 购物车、订单、浏览记录批量读取商品时单个商品的缓存时间(秒)
+SKU_CACHE_TTL = 60
+
+# 商品详情页每次加载的评论数
+GOODS_COMMENT_PAGE_SIZE = 10
+
+# 列表页排序、新品推荐使用redis排序集合，集合用 python manage.py rebuild_goods_rank 从数据库重建
+GOODS_RANK_ENABLED = True
+
+# 后台修改首页数据后，合并该时间窗口(秒)内的多次请求，只重新生成一次静态首页
+STATIC_INDEX_DEBOUNCE = 5
+
+# 购物车过期时间(秒)，每次访问重新计算; 空闲超过 CART_ARCHIVE_IDLE 秒的购物车由定时任务每 CART_ARCHIVE_INTERVAL 秒检查一次并转存到数据库
+CART_TTL = 3600 * 24 * 30
+CART_ARCHIVE_IDLE = 3600 * 24 * 7
+CART_ARCHIVE_INTERVAL = 3600
+# 购物车最多的商品条目数，小于redis的 hash-max-ziplist-entries(默认128)，购物车始终使用紧凑编码
+CART_MAX_LINES = 100
+# 未登陆用户按session保存的购物车的过期时间(秒)，登陆时合并到用户购物车
+ANON_CART_TTL = 3600 * 24
+
+# 下单方式: pessimistic 悲观锁(SELECT ... FOR UPDATE)，optimistic 乐观锁(条件更新失败后随机等待重试)
+# 两种方式的对比: python manage.py order_commit_benchmark
+ORDER_COMMIT_MODE = 'pessimistic'
+# 乐观锁最多尝试的次数，第n次失败后最多随机等待 n * ORDER_RETRY_JITTER 秒
+ORDER_OPTIMISTIC_RETRIES = 3
+ORDER_RETRY_JITTER = 0.05
+# 异步下单: 提交订单只做简单校验后放入celery的order队列，由单独的worker限制并发创建订单，
+# 启动: celery -A celery_tasks.tasks worker -Q order -c 4; 下单结果保存 ORDER_TICKET_TTL 秒
+ORDER_COMMIT_ASYNC = False
+ORDER_TICKET_TTL = 600
+# 用户中心订单页每页的订单数; 用户订单统计(总数、各状态的订单数)的缓存时间
+ORDER_PAGE_SIZE = 1
+ORDER_SUMMARY_TTL = 3600
+# 未支付订单在 ORDER_PAY_TIMEOUT 秒后取消并恢复库存，每 ORDER_EXPIRE_INTERVAL 秒检查一次，
+# 每批取消 ORDER_EXPIRE_BATCH_SIZE 个订单(python manage.py order_expiry load 将已有的未支付订单加入检查)
+ORDER_PAY_TIMEOUT = 1800
+ORDER_EXPIRE_INTERVAL = 60
+ORDER_EXPIRE_BATCH_SIZE = 500
+# 热点商品预留库存(python manage.py reserve_stock load 商品id)，已扣减的库存每 STOCK_RESERVE_SETTLE_INTERVAL 秒批量写入数据库
+STOCK_RESERVE_SETTLE_INTERVAL = 10
+# /order/check 等待支付结果通知的最长秒数，超时后主动查询一次支付宝并返回，由页面延长间隔后再次请求;
+# 等待期间占用一个同步的uwsgi worker，不宜过长
+ORDER_CHECK_WAIT = 2
+
+# 配置session存储，到不淘汰的用户数据redis中，缓存被淘汰或清空时用户不会掉线
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
-SESSION_CACHE_ALIAS = "default"
+SESSION_CACHE_ALIAS = "user_store"
 
 # 未登陆时默认跳转登陆页
 LOGIN_URL = '/user/login'
@@ -175,10 +257,25 @@ HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
 # 改变haystack默认分页方式
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 1
 
+# 支付宝网关地址，沙箱的话加dev; 请求超时秒数; 每个进程与网关保持的长连接数(不少于uwsgi的线程数)
+ALIPAY_GATEWAY = 'https://openapi.alipaydev.com/gateway.do'
+ALIPAY_TIMEOUT = 15
+ALIPAY_POOL_SIZE = 8
 # 支付宝沙箱:appid,商户uid,本地私钥，支付宝公钥
 ALIPAY_APP_ID = '2016101000650842'
 ALIPAY_UID = '2088102178890806'
 MY_PRIVATE_KEY = os.path.join(BASE_DIR, 'utils/pay/app_private_key.pem')
 ALIPAY_PUBLIC_KEY = os.path.join(BASE_DIR, 'utils/pay/alipay_public_key.pem')
+# 支付宝异步通知地址，需要支付宝能够访问
+ALIPAY_NOTIFY_URL = VM_IP + '/order/notify'
+# 未支付订单对账: 每 ALIPAY_RECONCILE_INTERVAL 秒查询一次创建超过 ALIPAY_RECONCILE_MIN_AGE 秒的订单，
+# 每批 ALIPAY_RECONCILE_BATCH_SIZE 个，ALIPAY_RECONCILE_WORKERS 个线程并发，每秒最多 ALIPAY_RECONCILE_RATE 次请求，
+# 一次最多 ALIPAY_RECONCILE_LIMIT 个订单(不超过 速率*间隔，避免两次对账重叠)
+ALIPAY_RECONCILE_INTERVAL = 60
+ALIPAY_RECONCILE_MIN_AGE = 300
+ALIPAY_RECONCILE_BATCH_SIZE = 200
+ALIPAY_RECONCILE_WORKERS = 8
+ALIPAY_RECONCILE_RATE = 20
+ALIPAY_RECONCILE_LIMIT = 1000
 
 
@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+def _lock_key(key):
+    """重建缓存时使用的锁的键"""
+    return '%s_rebuild_lock' % key
+
+
+def _rebuild(key, builder, soft_ttl, hard_ttl):
+    """重新计算数据并写入缓存，缓存中保存数据及其软过期时间"""
+    data = builder()
+    entry = {'data': data, 'expire': time.time() + soft_ttl}
+    cache.set(key, entry, hard_ttl)
+    return data
+
+
+def _background_rebuild(key, builder, soft_ttl, hard_ttl):
+    """在后台线程中提前刷新缓存"""
+    try:
+        _rebuild(key, builder, soft_ttl, hard_ttl)
+    except Exception:
+        logger.exception('refresh cache %s failed', key)
+    finally:
+        cache.delete(_lock_key(key))
+        # 线程中打开的数据库连接需要手动关闭
+        connection.close()
+
+
+def get_or_rebuild(key, builder, soft_ttl, hard_ttl, lock_timeout=10, refresh_ahead=0):
+    """获取缓存数据，防止缓存失效时大量请求同时重建(缓存击穿)
+
+    key: 缓存的键
+    builder: 无参函数，返回要缓存的数据
+    soft_ttl: 软过期时间(秒)，超过后数据视为陈旧，由一个请求重建，其他请求继续使用陈旧数据
+    hard_ttl: 硬过期时间(秒)，缓存真正被删除的时间，应大于soft_ttl
+    lock_timeout: 重建锁的过期时间(秒)，同时也是缓存不存在时其他请求等待重建的最长时间
+    refresh_ahead: 距离软过期还剩多少秒时，由一个请求在后台线程中提前刷新，0 表示不提前刷新
+    """
+    entry = cache.get(key)
+    now = time.time()
+
+    if entry is not None:
+        remaining = entry['expire'] - now
+        if remaining > refresh_ahead:
+            # 数据新鲜
+            return entry['data']
+
+        # 只有拿到锁的请求去重建，其他请求直接返回现有数据
+        if cache.add(_lock_key(key), 1, lock_timeout):
+            if remaining > 0:
+                # 即将过期，后台提前刷新，当前请求不等待
+                threading.Thread(target=_background_rebuild,
+                                 args=(key, builder, soft_ttl, hard_ttl),
+                                 daemon=True).start()
+            else:
+                # 已经陈旧，由当前请求重建
+                try:
+                    return _rebuild(key, builder, soft_ttl, hard_ttl)
+                finally:
+                    cache.delete(_lock_key(key))
+        return entry['data']
+
+    # 缓存不存在，没有陈旧数据可用
+    if cache.add(_lock_key(key), 1, lock_timeout):
+        try:
+            return _rebuild(key, builder, soft_ttl, hard_ttl)
+        finally:
+            cache.delete(_lock_key(key))
+
+    # 其他请求正在重建，等待其结果
+    deadline = now + lock_timeout
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['data']
+
+    # 等待超时，重建的请求可能已异常退出，自己计算但不写缓存
+    return builder()
+
+
+def expire_cache(key):
+    """将缓存标记为陈旧，下一个请求重建，重建完成前其他请求仍使用旧数据"""
+    entry = cache.get(key)
+    if entry is not None:
+        entry['expire'] = 0
+        cache.set(key, entry, cache.ttl(key) or None)
+
+
+class TwoTierCache(object):
+    """两级缓存：进程内LRU缓存在前，django的redis缓存在后
+
+    适合很少修改、但每个请求都要读取的数据，进程内命中时连redis也不访问。
+    数据修改时调用 invalidate，通过redis发布订阅通知所有进程删除本地缓存。
+    """
+    # 失效通知的频道
+    channel = 'two_tier_cache_invalidate'
+
+    def __init__(self, max_size=256, local_ttl=300):
+        self.max_size = max_size  # 本地缓存最多保存的键数
+        self.local_ttl = local_ttl  # 本地缓存过期时间，防止失效通知丢失时数据一直不更新
+        self._data = OrderedDict()  # {key: (过期时间, 数据)}
+        self._lock = threading.Lock()
+        self._listener_pid = None  # 启动订阅线程的进程，fork后的子进程需重新启动
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get(self, key, builder, timeout):
+        """获取数据，两级缓存都没有时调用builder计算并写入缓存，timeout 为redis缓存的过期时间"""
+        self._ensure_listener()
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                # 移到末尾，表示最近使用
+                self._data.move_to_end(key)
+                self.local_hits += 1
+                return item[1]
+
+        data = cache.get(key)
+        if data is not None:
+            self.redis_hits += 1
+        else:
+            self.misses += 1
+            data = builder()
+            cache.set(key, data, timeout)
+        self._set_local(key, data)
+        return data
+
+    def invalidate(self, key):
+        """删除两级缓存中的数据，并通知其他进程"""
+        cache.delete(key)
+        self._delete_local(key)
+        get_redis_connection('default').publish(self.channel, key)
+
+    def stats(self):
+        """命中统计"""
+        return {
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+    def _set_local(self, key, data):
+        with self._lock:
+            self._data[key] = (time.time() + self.local_ttl, data)
+            self._data.move_to_end(key)
+            # 超出容量，删除最久未使用的
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def _delete_local(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _ensure_listener(self):
+        """在当前进程中启动订阅失效通知的线程"""
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            # fork 得到的本地缓存可能已经过时
+            self._data.clear()
+            self._listener_pid = pid
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        """接收失效通知，删除本地缓存"""
+        while True:
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    key = message['data']
+                    if isinstance(key, bytes):
+                        key = key.decode()
+                    self._delete_local(key)
+            except Exception:
+                logger.exception('two tier cache listener disconnected')
+            # 断开期间可能错过通知，清空本地缓存后重连
+            with self._lock:
+                self._data.clear()
+            time.sleep(1)
+
+
+# 商品种类等目录数据的两级缓存，每个进程一个实例
+catalog_cache = TwoTierCache(max_size=settings.LOCAL_CACHE_MAX_SIZE, local_ttl=settings.LOCAL_CACHE_TTL)
@@ -0,0 +1,9 @@
+from django.core.paginator import Paginator
+
+
+class CountedPaginator(Paginator):
+    """使用已知总数的分页器，不再对查询集执行 COUNT(*)"""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._count = count
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
 import logging
+import threading
 import traceback
+from datetime import datetime, timedelta
+
+import requests
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from requests.adapters import HTTPAdapter
 
-from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
-from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
 from alipay.aop.api.FileItem import FileItem
 from alipay.aop.api.domain.AlipayTradeAppPayModel import AlipayTradeAppPayModel
 from alipay.aop.api.domain.AlipayTradePagePayModel import AlipayTradePagePayModel
@@ -23,10 +30,16 @@ from alipay.aop.api.response.AlipayTradePayResponse import AlipayTradePayRespons
 from alipay.aop.api.response.AlipayTradeQueryResponse import AlipayTradeQueryResponse
 from alipay.aop.api.domain.AlipayTradeQueryModel import AlipayTradeQueryModel
 from alipay.aop.api.request.AlipayTradeQueryRequest import AlipayTradeQueryRequest
+from alipay.aop.api.constant.CommonConstants import PATTERN_RESPONSE_BEGIN, PATTERN_RESPONSE_SIGN_BEGIN
+from alipay.aop.api.constant.ParamConstants import COMMON_PARAM_KEYS, P_APP_ID, P_CHARSET, P_FORMAT, P_SIGN, \
+    P_SIGN_TYPE, P_TIMESTAMP
+from alipay.aop.api.exception.Exception import ResponseException
+from alipay.aop.api.util.SignatureUtils import get_sign_content, fill_private_key_marker, fill_public_key_marker
+from alipay.aop.api.util.WebUtils import url_encode
 
 """
 支付宝SDK使用总结：
-    1.基础配置：注意事项见 alipay_base_config
+    1.基础配置：注意事项见 get_alipay_client
     2.业务所需api 导入
         1.明确请求的业务，到 alipay.aop.api.request.下找对应名
         2.请求对象model alipay.aop.api.domain.下找对应名，在大的model下可能参数是符合的在alipay.aop.api.domain.再找
@@ -39,6 +52,7 @@ from alipay.aop.api.request.AlipayTradeQueryRequest import AlipayTradeQueryReque
 """
 
 from django.conf import settings
+from django.utils import timezone
 
 logging.basicConfig(
     # level=logging.INFO,  默认日志打印级别
@@ -48,37 +62,110 @@ logging.basicConfig(
 logger = logging.getLogger('')
 
 
-def alipay_base_config():
-    """
-    设置配置，包括支付宝网关地址、app_id、应用私钥、支付宝公钥等，其他配置值可以查看AlipayClientConfig的定义。
-    """
+# 支付宝交易在订单支付截止时间前多少秒关闭，留出异步通知到达的时间
+ALIPAY_CLOSE_AHEAD = 60
 
-    alipay_client_config = AlipayClientConfig()
-    alipay_client_config.server_url = 'https://openapi.alipaydev.com/gateway.do'  # 支付宝网关地址，沙箱的话加dev
-    alipay_client_config.app_id = settings.ALIPAY_APP_ID
-    # 公钥，私钥要读出来
-    with open(settings.MY_PRIVATE_KEY, 'r') as f:
-        alipay_client_config.app_private_key = f.read()
 
-    with open(settings.ALIPAY_PUBLIC_KEY, 'r') as f:
-        alipay_client_config.alipay_public_key = f.read()
-    # 沙箱模式
-    alipay_client_config.sandbox_debug = True
+class AlipayClient(object):
+    """进程内共用的支付宝客户端，由 get_alipay_client 创建
 
+    密钥只在创建时读取并解析一次，签名、验签直接使用解析后的密钥;
+    签名使用 pycrypto(SDK已依赖)，比SDK使用的纯python的rsa库快一个数量级，签名结果相同;
+    请求通过 requests.Session 的连接池发送，与网关保持长连接。
+    创建后不再修改，每次请求的数据都是局部变量，uwsgi 的多个线程可以共用一个客户端。
     """
-    得到客户端对象。
-    注意，一个alipay_client_config对象对应一个DefaultAlipayClient，定义DefaultAlipayClient对象后，alipay_client_config不得修改，如果想使用不同的配置，请定义不同的DefaultAlipayClient。
-    logger参数用于打印日志，不传则不打印，建议传递。
-    """
-    client = DefaultAlipayClient(alipay_client_config=alipay_client_config, logger=logger)
-    return client
+    charset = 'utf-8'
+    sign_type = 'RSA2'
+
+    def __init__(self, server_url, app_id, app_private_key, alipay_public_key, timeout=15, pool_size=10):
+        self.server_url = server_url
+        self.app_id = app_id
+        self.timeout = timeout
+        self.signer = PKCS1_v1_5.new(RSA.importKey(fill_private_key_marker(app_private_key)))
+        self.verifier = PKCS1_v1_5.new(RSA.importKey(fill_public_key_marker(alipay_public_key)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def sign(self, content):
+        """RSA2(SHA256)签名，返回base64字符串"""
+        signature = self.signer.sign(SHA256.new(content.encode(self.charset)))
+        return base64.b64encode(signature).decode()
+
+    def verify(self, message, sign):
+        """用支付宝公钥验证签名，message: bytes"""
+        try:
+            return bool(self.verifier.verify(SHA256.new(message), base64.b64decode(sign)))
+        except ValueError:
+            return False
+
+    def prepare_params(self, request):
+        """构造请求参数，返回 公共参数(含签名), 业务参数"""
+        params = request.get_params()
+        params[P_TIMESTAMP] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        params[P_APP_ID] = self.app_id
+        params[P_CHARSET] = self.charset
+        params[P_FORMAT] = 'json'
+        params[P_SIGN_TYPE] = self.sign_type
+        common_params = {k: params.pop(k) for k in COMMON_PARAM_KEYS if params.get(k)}
+        all_params = dict(params, **common_params)
+        common_params[P_SIGN] = self.sign(get_sign_content(all_params))
+        return common_params, params
+
+    def page_execute(self, request):
+        """页面跳转接口，返回带签名参数的支付页url"""
+        common_params, params = self.prepare_params(request)
+        return self.server_url + '?' + url_encode(common_params, self.charset) + '&' + url_encode(params, self.charset)
+
+    def execute(self, request):
+        """请求接口，返回验签后的响应内容(json字符串)"""
+        common_params, params = self.prepare_params(request)
+        response = self.session.post(self.server_url, params=common_params, data=params, timeout=self.timeout)
+        response.raise_for_status()
+        return self.parse_response(response.content.decode(self.charset))
+
+    def parse_response(self, content):
+        """取出响应中 xxx_response 的内容并验证签名"""
+        begin = PATTERN_RESPONSE_BEGIN.search(content)
+        # 签名在最后一个 "sign" 之后
+        sign_begin = None
+        for sign_begin in PATTERN_RESPONSE_SIGN_BEGIN.finditer(content):
+            pass
+        if not begin or not sign_begin:
+            raise ResponseException('response shape maybe illegal. ' + content)
+        response_content = content[begin.end() - 1:sign_begin.start() + 1]
+        sign = content[sign_begin.end():content.find('"', sign_begin.end())]
+        if not self.verify(response_content.encode(self.charset), sign):
+            raise ResponseException('response sign verify failed. ' + content)
+        return response_content
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_alipay_client():
+    """获取进程内共用的支付宝客户端，第一次调用时读取密钥创建"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # 公钥，私钥要读出来
+                with open(settings.MY_PRIVATE_KEY, 'r') as f:
+                    app_private_key = f.read()
+                with open(settings.ALIPAY_PUBLIC_KEY, 'r') as f:
+                    alipay_public_key = f.read()
+                _client = AlipayClient(settings.ALIPAY_GATEWAY, settings.ALIPAY_APP_ID, app_private_key,
+                                       alipay_public_key, settings.ALIPAY_TIMEOUT, settings.ALIPAY_POOL_SIZE)
+    return _client
 
 
 def alipay_trade_page(order):
     """
     页面接口示例：alipay.trade.page.pay,--统一收单下单
     """
-    client = alipay_base_config()
+    client = get_alipay_client()
     # 对照接口文档，构造请求对象
     model = AlipayTradePagePayModel()
     # 必填
@@ -86,6 +173,9 @@ def alipay_trade_page(order):
     model.total_amount = str(order.total_price)
     model.subject = "天天生鲜测试"
     model.product_code = "FAST_INSTANT_TRADE_PAY"
+    # 支付宝在订单超时取消前关闭交易，订单取消后不能再完成支付
+    time_expire = order.create_time + timedelta(seconds=settings.ORDER_PAY_TIMEOUT - ALIPAY_CLOSE_AHEAD)
+    model.time_expire = timezone.localtime(time_expire).strftime('%Y-%m-%d %H:%M:%S')
     # 选填中有些必填
     settle_detail_info = SettleDetailInfo()
     settle_detail_info.amount = str(order.total_price)  # 必填
@@ -103,15 +193,17 @@ def alipay_trade_page(order):
     # model.sub_merchant = sub_merchant
 
     request = AlipayTradePagePayRequest(biz_model=model)
-    # 得到构造的请求，如果http_method是GET，则是一个带完成请求参数的url，如果http_method是POST，则是一段HTML表单片段
-    response = client.page_execute(request, http_method="GET")
+    # 支付完成后支付宝异步通知的地址
+    request.notify_url = settings.ALIPAY_NOTIFY_URL
+    # 得到构造的请求，带完整请求参数的url
+    response = client.page_execute(request)
     return response
     # print("alipay.trade.page.pay response:" + response)
 
 
 def alipay_trade_query(order):
     """查询订单结果"""
-    client = alipay_base_config()
+    client = get_alipay_client()
     # 对照接口文档，构造请求对象
     model = AlipayTradeQueryModel()
     # 通过先前提交的订单号（非支付宝订单号），查询支付结果
@@ -135,8 +227,17 @@ def alipay_trade_query(order):
         return response
 
 
+def alipay_verify_notify(params):
+    """验证支付宝异步通知的签名，params: 通知的全部参数
 
-
-
-
-
+    除 sign、sign_type 外的参数按键排序拼接后，用支付宝公钥验证 RSA2 签名
+    """
+    params = dict(params)
+    sign = params.pop('sign', None)
+    params.pop('sign_type', None)
+    if not sign or params.get('app_id') != settings.ALIPAY_APP_ID:
+        return False
+    if not get_alipay_client().verify(get_sign_content(params).encode('utf-8'), sign):
+        logger.warning('alipay notify verify failed: %s', params.get('out_trade_no'))
+        return False
+    return True
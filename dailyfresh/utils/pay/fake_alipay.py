@@ -0,0 +1,71 @@
+import json
+import threading
+import time
+import uuid
+
+from alipay.aop.api.response.AlipayTradeQueryResponse import AlipayTradeQueryResponse
+
+
+class FakeAlipayGateway(object):
+    """本地模拟的支付宝交易查询接口，离线测试对账任务的吞吐量和正确性
+
+    query 与 alipay_trade_query 的参数和返回值相同; 每次查询等待 latency 秒模拟网络延迟，
+    每秒调用超过 rate_limit 次时与网关一样返回限流错误
+    """
+
+    def __init__(self, latency=0.05, rate_limit=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        # 订单id: (交易状态, 支付宝交易号)，不在其中的订单视为交易不存在
+        self.trades = {}
+        self.calls = 0
+        self.throttled = 0
+        self.max_concurrency = 0
+        self._concurrency = 0
+        # 当前秒, 当前秒内的调用次数
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+
+    def pay(self, order_id):
+        """买家完成支付，返回支付宝交易号"""
+        trade_no = time.strftime('%Y%m%d') + uuid.uuid4().hex[:20]
+        self.trades[order_id] = ('TRADE_SUCCESS', trade_no)
+        return trade_no
+
+    def wait(self, order_id):
+        """买家打开了支付页但还未付款"""
+        self.trades[order_id] = ('WAIT_BUYER_PAY', '')
+
+    def close(self, order_id):
+        """交易超时关闭"""
+        self.trades[order_id] = ('TRADE_CLOSED', '')
+
+    def query(self, order):
+        """查询交易状态"""
+        with self._lock:
+            self.calls += 1
+            self._concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self._concurrency)
+            second = int(time.time())
+            count = self._window[1] + 1 if self._window[0] == second else 1
+            self._window = (second, count)
+            throttled = self.rate_limit is not None and count > self.rate_limit
+            if throttled:
+                self.throttled += 1
+
+        try:
+            time.sleep(self.latency)
+            if throttled:
+                content = {'code': '20000', 'msg': 'Service Currently Unavailable', 'sub_code': 'isp.rate-limited'}
+            elif order.order_id not in self.trades:
+                content = {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+            else:
+                trade_status, trade_no = self.trades[order.order_id]
+                content = {'code': '10000', 'msg': 'Success', 'out_trade_no': order.order_id,
+                           'trade_status': trade_status, 'trade_no': trade_no}
+            response = AlipayTradeQueryResponse()
+            response.parse_response_content(json.dumps(content))
+            return response
+        finally:
+            with self._lock:
+                self._concurrency -= 1
@@ -0,0 +1,95 @@
+from django.conf import settings
+from cart.utils import cart_totals, get_cart_id, cart_key, cart_totals_key, cart_archived_key
+from utils.user_store import get_user_store, user_store_key
+
+
+class UserState(object):
+    """一个请求中用户购物车、浏览记录等redis数据的访问对象
+
+    读写命令先放入同一个pipeline，第一次需要读取结果或请求结束时才一次发送给redis
+    """
+
+    # 浏览记录最多保存的条数
+    history_size = 5
+
+    def __init__(self, request):
+        self.request = request
+        self.user = request.user
+        self._pipe = None
+        self._cart_count = None
+
+    @property
+    def history_key(self):
+        return user_store_key('history_%d' % self.user.id)
+
+    def _pipeline(self):
+        if self._pipe is None:
+            self._pipe = get_user_store().pipeline(transaction=False)
+        return self._pipe
+
+    def _execute(self, count=1):
+        """发送pipeline中的所有命令，返回最后一条命令的结果，count大于1时返回最后count条命令的结果"""
+        pipe, self._pipe = self._pipe, None
+        results = pipe.execute()
+        return results[-1] if count == 1 else results[-count:]
+
+    @property
+    def cart_count(self):
+        """购物车中商品的条目数，未登录时为按session保存的购物车"""
+        # 只是浏览页面时不创建session
+        cart_id = get_cart_id(self.request, create=False)
+        if cart_id is None:
+            return 0
+        if self._cart_count is None:
+            # 直接读取增量维护的购物车统计，pipeline中不使用脚本(EVALSHA会在执行前多发送一次SCRIPT EXISTS)
+            pipe = self._pipeline()
+            pipe.hget(cart_totals_key(cart_id), 'lines')
+            pipe.exists(cart_archived_key(cart_id))
+            pipe.exists(cart_key(cart_id))
+            # 与购物车脚本一样，每次访问都重置购物车的过期时间
+            ttl = settings.ANON_CART_TTL if str(cart_id).startswith('anon_') else settings.CART_TTL
+            pipe.expire(cart_key(cart_id), ttl)
+            pipe.expire(cart_totals_key(cart_id), ttl)
+            lines, archived, exists = self._execute(5)[:3]
+            if archived or (lines is None and exists):
+                # 购物车已转存到数据库，或旧的购物车还没有统计，由脚本恢复或建立统计后读取
+                lines = cart_totals(cart_id)[2]
+            self._cart_count = int(lines or 0)
+        return self._cart_count
+
+    def add_history(self, sku_id):
+        """添加用户浏览记录，在下一次读取或请求结束时写入"""
+        if not self.user.is_authenticated():
+            return
+        pipe = self._pipeline()
+        # 移除当前商品的商品的浏览记录
+        pipe.lrem(self.history_key, 0, sku_id)
+        # 添加商品到浏览记录
+        pipe.lpush(self.history_key, sku_id)
+        # 只保留最新的浏览记录
+        pipe.ltrim(self.history_key, 0, self.history_size)
+
+    def get_history(self):
+        """获取最近浏览的商品id列表"""
+        if not self.user.is_authenticated():
+            return []
+        self._pipeline().lrange(self.history_key, 0, self.history_size - 1)
+        return [int(sku_id) for sku_id in self._execute()]
+
+    def flush(self):
+        """发送还未执行的写操作"""
+        if self._pipe is not None:
+            self._execute()
+
+
+class UserStateMiddleware(object):
+    """给每个请求添加 request.user_state，请求结束时写入未发送的操作，需放在认证中间件之后"""
+
+    def process_request(self, request):
+        request.user_state = UserState(request)
+
+    def process_response(self, request, response):
+        user_state = getattr(request, 'user_state', None)
+        if user_state is not None:
+            user_state.flush()
+        return response
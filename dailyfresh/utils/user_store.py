@@ -0,0 +1,22 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+def get_user_store():
+    """购物车、浏览记录等用户数据所在的redis连接，与缓存分开配置"""
+    return get_redis_connection(settings.USER_STORE_ALIAS)
+
+
+def user_store_key(key):
+    """用户数据的键，添加统一的前缀"""
+    return settings.USER_STORE_KEY_PREFIX + key
+
+
+_scripts = {}
+
+
+def user_store_script(lua):
+    """在用户数据redis中注册lua脚本，之后通过EVALSHA调用"""
+    if lua not in _scripts:
+        _scripts[lua] = get_user_store().register_script(lua)
+    return _scripts[lua]